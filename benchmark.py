@@ -0,0 +1,498 @@
+"""Офлайн-бенчмарк бота: фейковые буры, фейковый Bot API и одноразовое хранилище.
+
+Гоняет run_parser_cycle / process_parsed_post и обработчики кнопок из main.py
+против локальных заглушек и печатает посты/сек, перцентили длительности
+прохода, обращения к базе на пост и пиковый RSS. Реальные сервисы не трогает.
+
+    python benchmark.py                                  # хранилище в памяти
+    python benchmark.py --labels 30 --posts 20 --latency 0.1 --rate-429 0.05
+    python benchmark.py --database-url postgresql://localhost/bench
+    python benchmark.py --sqlite
+
+С --database-url бенчмарк создаёт в этой базе временную схему, гоняет
+настоящие SQL-хелперы и удаляет схему в конце. С --sqlite те же хелперы
+работают со встроенной SQLite во временном файле. Без них хелперы базы
+подменяются MemoryStorage: меряется конвейер, а не база.
+"""
+
+import os
+import sys
+import time
+import json
+import random
+import asyncio
+import argparse
+import resource
+import shutil
+import tempfile
+import importlib
+from io import BytesIO
+from collections import Counter
+
+from aiohttp import web
+from PIL import Image
+
+BENCH_TOKEN = "123456:BENCHMARK"
+MOD_CHAT_ID = -100500
+ADMIN_ID = 1
+EXTRA_TAGS = ["solo", "ai", "thighhighs", "stockings", "glasses", "outdoors", "smile", "blush"]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--labels", type=int, default=12, help="сколько лейблов (часть пересекается по базовому тегу)")
+    parser.add_argument("--base-tags", type=int, default=4, help="сколько разных базовых тегов")
+    parser.add_argument("--cycles", type=int, default=5, help="проходов парсера")
+    parser.add_argument("--posts", type=int, default=15, help="новых постов на базовый тег за проход")
+    parser.add_argument("--latency", type=float, default=0.02, help="задержка ответа буры, сек.")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="доля ответов 429 от буры")
+    parser.add_argument("--tg-latency", type=float, default=0.01, help="задержка ответа Bot API, сек.")
+    parser.add_argument("--tg-rate-429", type=float, default=0.0, help="доля ответов 429 от Bot API")
+    parser.add_argument("--tg-url-fail", type=float, default=0.0, help="доля ссылок, которые Bot API «не смог скачать»")
+    parser.add_argument("--callbacks", type=int, default=20, help="сколько нажатий «В очередь» сымитировать")
+    parser.add_argument("--database-url", help="Postgres для одноразовой схемы вместо хранилища в памяти")
+    parser.add_argument("--sqlite", action="store_true", help="встроенная SQLite во временном файле вместо хранилища в памяти")
+    parser.add_argument("--real-limits", action="store_true", help="не снимать лимиты скорости бота (бур и Telegram)")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+def tiny_jpeg(seed: int) -> bytes:
+    rnd = random.Random(seed)
+    img = Image.new("L", (8, 8))
+    img.putdata([rnd.randrange(256) for _ in range(64)])
+    buf = BytesIO()
+    img.resize((150, 150)).save(buf, "JPEG")
+    return buf.getvalue()
+
+# --- ФЕЙКОВАЯ БУРА ---
+
+class FakeBooru:
+    """dapi-совместимый /index.php с синтетическими постами, задержкой и 429."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed)
+        self.posts = []  # по возрастанию id
+        self.next_id = 1
+        self.requests = Counter()
+        self.previews = [tiny_jpeg(i) for i in range(16)]
+        self.base_url = None
+
+    def publish(self, per_tag: int):
+        for base in range(self.args.base_tags):
+            for _ in range(per_tag):
+                post_id = self.next_id
+                self.next_id += 1
+                tags = {f"tag{base}", *self.rnd.sample(EXTRA_TAGS, 3)}
+                # Часть постов — перезаливы старых артов с тем же md5
+                md5 = f"{self.rnd.randrange(10 ** 6):032x}" if self.rnd.random() < 0.05 else f"{post_id:032x}"
+                self.posts.append({
+                    "id": post_id,
+                    "md5": md5,
+                    "tags": " ".join(sorted(tags)),
+                    "file_url": f"{self.base_url}/file/{post_id}.jpg",
+                    "preview_url": f"{self.base_url}/preview/{post_id}.jpg",
+                })
+
+    async def index(self, request: web.Request):
+        self.requests["index"] += 1
+        await asyncio.sleep(self.args.latency)
+        if self.rnd.random() < self.args.rate_429:
+            self.requests["429"] += 1
+            return web.Response(status=429, headers={"Retry-After": "0.2"})
+
+        terms = request.query.get("tags", "").replace("+", " ").split()
+        limit = int(request.query.get("limit", "100"))
+        after, ascending, pos, neg = 0, False, set(), set()
+        for term in terms:
+            if term.startswith("id:>"): after = int(term[4:])
+            elif term == "sort:id:asc": ascending = True
+            elif ":" in term: continue
+            elif term.startswith("-"): neg.add(term[1:])
+            else: pos.add(term)
+
+        matched = []
+        for post in (self.posts if ascending else reversed(self.posts)):
+            tags = set(post["tags"].split())
+            if post["id"] > after and pos <= tags and not neg & tags:
+                matched.append(post)
+                if len(matched) >= limit: break
+        return web.json_response(matched)
+
+    async def image(self, request: web.Request):
+        self.requests["image"] += 1
+        post_id = int(request.match_info["post_id"])
+        return web.Response(body=self.previews[post_id % len(self.previews)], content_type="image/jpeg")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/index.php", self.index)
+        app.router.add_get(r"/preview/{post_id:\d+}.jpg", self.image)
+        app.router.add_get(r"/file/{post_id:\d+}.jpg", self.image)
+        return app
+
+# --- ФЕЙКОВЫЙ BOT API ---
+
+class FakeTelegram:
+    """Отвечает на методы Bot API правдоподобными объектами и считает вызовы."""
+
+    def __init__(self, args):
+        self.args = args
+        self.rnd = random.Random(args.seed + 1)
+        self.calls = Counter()
+        self.next_message_id = 1
+        self.cards = []  # (message_id, caption, callback_data) карточек модерации
+
+    def message(self, chat_id: int, **fields) -> dict:
+        msg = {
+            "message_id": self.next_message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private" if chat_id > 0 else "supergroup"},
+            **fields,
+        }
+        self.next_message_id += 1
+        return msg
+
+    def photo(self) -> list:
+        return [{"file_id": f"AgAC{self.next_message_id}", "file_unique_id": f"u{self.next_message_id}", "width": 150, "height": 150}]
+
+    async def handle(self, request: web.Request):
+        method = request.match_info["method"].lower()
+        self.calls[method] += 1
+        await asyncio.sleep(self.args.tg_latency)
+        if method.startswith("send") and self.rnd.random() < self.args.tg_rate_429:
+            self.calls["429"] += 1
+            return web.json_response({
+                "ok": False, "error_code": 429,
+                "description": "Too Many Requests: retry after 1", "parameters": {"retry_after": 1}
+            }, status=429)
+
+        data = await request.post()
+        chat_id = int(data.get("chat_id", ADMIN_ID))
+        photo = data.get("photo")
+        if method == "sendphoto" and isinstance(photo, str) and photo.startswith("http") and self.rnd.random() < self.args.tg_url_fail:
+            self.calls["url_fail"] += 1
+            return web.json_response({"ok": False, "error_code": 400, "description": "Bad Request: failed to get HTTP URL content"}, status=400)
+        if method == "sendphoto":
+            if not isinstance(photo, str) or photo.startswith("attach://"): self.calls["upload"] += 1
+            result = self.message(chat_id, photo=self.photo(), caption=data.get("caption", ""))
+            if chat_id == MOD_CHAT_ID and data.get("reply_markup"):
+                markup = json.loads(data["reply_markup"])
+                self.cards.append((result["message_id"], result["caption"], markup["inline_keyboard"][0][0]["callback_data"]))
+        elif method == "sendmessage":
+            result = self.message(chat_id, text=data.get("text", ""))
+        elif method == "sendmediagroup":
+            result = [self.message(chat_id, photo=self.photo()) for _ in json.loads(data["media"])]
+        elif method == "getme":
+            result = {"id": 42, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        else:
+            result = True
+        return web.json_response({"ok": True, "result": result})
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.handle)
+        return app
+
+# --- ХРАНИЛИЩЕ ---
+
+class MemoryStorage:
+    """Хелперы базы из main.py, реализованные на словарях; каждый вызов — одно «обращение»."""
+
+    HELPERS = (
+        "claim_new_posts", "save_phashes", "advance_cursor", "save_poll_state",
+        "enqueue_post", "save_file_id", "dequeue_post", "get_queue_page", "get_queue_size",
+        "save_mod_card", "load_mod_card", "delete_mod_card",
+    )
+
+    def __init__(self, main):
+        self.main = main
+        self.calls = Counter()
+        self.seen = set()
+        self.md5 = {}
+        self.queue = {}
+        self.next_queue_id = 1
+        self.file_ids = {}
+        self.cards = {}
+
+    def install(self):
+        for name in self.HELPERS:
+            setattr(self.main, name, self.counted(name, getattr(self, name)))
+
+    def counted(self, name, func):
+        async def wrapper(*args, **kwargs):
+            self.calls[name] += 1
+            return await func(*args, **kwargs)
+        return wrapper
+
+    @property
+    def round_trips(self) -> int:
+        return sum(self.calls.values())
+
+    async def claim_new_posts(self, source, posts):
+        fresh = []
+        for post in posts:
+            key = (source, str(post.get("id")))
+            if key in self.seen: continue
+            self.seen.add(key)
+            file_md5 = post.get("md5") or post.get("hash")
+            dup = self.md5.get(file_md5) if file_md5 else None
+            if file_md5 and not dup:
+                self.md5[file_md5] = {"source": source, "post_id": key[1]}
+            fresh.append((post, dup))
+        return fresh
+
+    async def save_phashes(self, source, rows): pass
+
+    async def advance_cursor(self, source, tags, last_post_id):
+        key = (source, self.main.feed_key(tags))
+        self.main.PARSER_CURSORS[key] = max(self.main.PARSER_CURSORS.get(key, 0), last_post_id)
+
+    async def save_poll_state(self, key, state): pass
+
+    async def enqueue_post(self, file_id, caption=None, media_type="photo", file_url=None, post_key=None):
+        item_id = self.next_queue_id
+        self.next_queue_id += 1
+        self.queue[item_id] = {
+            "id": item_id, "file_id": self.file_ids.get(post_key, file_id), "type": media_type,
+            "caption": caption, "file_url": file_url, "post_key": post_key
+        }
+        return item_id
+
+    async def save_file_id(self, post_key, file_id):
+        self.file_ids[post_key] = file_id
+        for item in self.queue.values():
+            if item["post_key"] == post_key: item["file_id"] = file_id
+
+    async def dequeue_post(self, item_id=None):
+        if item_id is None:
+            item_id = min(self.queue, default=None)
+        return self.queue.pop(item_id, None)
+
+    async def get_queue_page(self, after_id=0, limit=5):
+        return [self.queue[i] for i in sorted(self.queue) if i > after_id][:limit]
+
+    async def get_queue_size(self):
+        return len(self.queue)
+
+    async def save_mod_card(self, chat_id, message_id, meta, purge_ttl=None):
+        self.cards[(chat_id, message_id)] = meta
+
+    async def load_mod_card(self, chat_id, message_id, ttl):
+        meta = self.cards.get((chat_id, message_id))
+        return (meta, 0.0) if meta else None
+
+    async def delete_mod_card(self, chat_id, message_id):
+        self.cards.pop((chat_id, message_id), None)
+
+class CountingPool:
+    """Обёртка над asyncpg-пулом, считающая запросы (round trips) к Postgres."""
+
+    COUNTED = {"execute", "executemany", "fetch", "fetchrow", "fetchval"}
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.round_trips = 0
+
+    def acquire(self):
+        return CountingAcquire(self)
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+class CountingAcquire:
+    def __init__(self, owner: CountingPool):
+        self.owner = owner
+        self.ctx = owner.pool.acquire()
+
+    async def __aenter__(self):
+        return CountingConnection(await self.ctx.__aenter__(), self.owner)
+
+    async def __aexit__(self, *exc):
+        return await self.ctx.__aexit__(*exc)
+
+class CountingConnection:
+    def __init__(self, conn, owner: CountingPool):
+        self.conn = conn
+        self.owner = owner
+
+    def __getattr__(self, name):
+        attr = getattr(self.conn, name)
+        if name not in CountingPool.COUNTED:
+            return attr
+
+        async def counted(*args, **kwargs):
+            self.owner.round_trips += 1
+            return await attr(*args, **kwargs)
+        return counted
+
+class CountingSqlite:
+    """Считает обращения к встроенной SQLite — вызовы в её поток."""
+
+    def __init__(self, db):
+        self.db = db
+        self.round_trips = 0
+        run = db.run
+
+        async def counted(func, *args):
+            self.round_trips += 1
+            return await run(func, *args)
+        db.run = counted
+
+# --- СЦЕНАРИИ ---
+
+def make_labels(args) -> list:
+    rnd = random.Random(args.seed + 2)
+    labels = []
+    for i in range(args.labels):
+        base = f"tag{i % args.base_tags}"
+        extras = rnd.sample(EXTRA_TAGS, rnd.randrange(0, 3))
+        tags = " ".join([base] + [f"-{t}" if rnd.random() < 0.3 else t for t in extras])
+        labels.append({
+            "name": f"label{i}", "tags": tags, "sources": ["rule34", "gelbooru"],
+            "emoji": "🏷", "mode": "AUTO" if i % 4 == 0 else "MANUAL", "signature": f"sig{i}"
+        })
+    return labels
+
+def percentile(values: list, pct: float) -> float:
+    if not values: return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def make_update(main, update_id: int, **payload):
+    from aiogram.types import Update
+    # Через context объекты привязываются к боту, как при настоящем поллинге
+    return Update.model_validate({"update_id": update_id, **payload}, context={"bot": main.bot})
+
+async def press_queue_buttons(main, tg: FakeTelegram, count: int) -> list:
+    latencies = []
+    user = {"id": ADMIN_ID, "is_bot": False, "first_name": "bench"}
+    for i, (message_id, caption, data) in enumerate(tg.cards[:count]):
+        message = {
+            "message_id": message_id, "date": int(time.time()), "chat": {"id": MOD_CHAT_ID, "type": "supergroup"},
+            "caption": caption, "photo": [{"file_id": f"AgAC{message_id}", "file_unique_id": f"u{message_id}", "width": 150, "height": 150}]
+        }
+        update = make_update(main, i + 1, callback_query={
+            "id": str(i), "from": user, "chat_instance": "bench", "message": message, "data": data
+        })
+        started = time.perf_counter()
+        await main.dp.feed_update(main.bot, update)
+        latencies.append(time.perf_counter() - started)
+    return latencies
+
+async def send_queue_command(main) -> float:
+    update = make_update(main, 10 ** 6, message={
+        "message_id": 10 ** 6, "date": int(time.time()), "chat": {"id": ADMIN_ID, "type": "private"},
+        "from": {"id": ADMIN_ID, "is_bot": False, "first_name": "bench"}, "text": "/queue"
+    })
+    started = time.perf_counter()
+    await main.dp.feed_update(main.bot, update)
+    return time.perf_counter() - started
+
+async def start_app(app: web.Application):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    port = site._server.sockets[0].getsockname()[1]
+    return runner, f"http://127.0.0.1:{port}"
+
+async def run(args):
+    booru, tg = FakeBooru(args), FakeTelegram(args)
+    booru_runner, booru.base_url = await start_app(booru.app())
+    tg_runner, tg_url = await start_app(tg.app())
+
+    schema = f"bench_{os.getpid()}"
+    cache_dir = tempfile.mkdtemp(prefix="bench_media_")
+    db_dir = tempfile.mkdtemp(prefix="bench_db_")
+    os.environ.update({
+        "MEDIA_CACHE_DIR": cache_dir,
+        "BOT_TOKEN": BENCH_TOKEN,
+        "R34_API_URL": f"{booru.base_url}/index.php",
+        "GELBOORU_API_URL": f"{booru.base_url}/index.php",
+        "TELEGRAM_API_URL": tg_url,
+        "ALLOWED_USER_1": str(ADMIN_ID),
+        "SQLITE_PATH": os.path.join(db_dir, "bench.db"),
+    })
+    if args.database_url:
+        # Неизвестные параметры DSN asyncpg передаёт как настройки сервера
+        sep = "&" if "?" in args.database_url else "?"
+        os.environ["DATABASE_URL"] = f"{args.database_url}{sep}search_path={schema}"
+    else:
+        os.environ.pop("DATABASE_URL", None)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    main = importlib.import_module("main")
+    import logging
+    logging.getLogger().setLevel(logging.WARNING)
+    logging.getLogger("aiogram").setLevel(logging.WARNING)
+
+    if not args.real_limits:
+        main.BOORU_RPS = main.BOORU_BURST = 1000
+        main.parser_budget = main.TokenBucket(1000, 1000)
+        main.TG_PRIVATE_RPS = main.TG_GROUP_RPS = main.TG_GROUP_BURST = 1000
+        main.outbox.global_bucket = main.TokenBucket(1000, 1000)
+
+    storage = None
+    if args.database_url:
+        import asyncpg
+        admin = await asyncpg.connect(args.database_url)
+        await admin.execute(f"CREATE SCHEMA {schema};")
+        await main.init_db()
+        main.storage.pool = storage = CountingPool(main.storage.pool)
+    elif args.sqlite:
+        await main.init_db()
+        storage = CountingSqlite(main.storage)
+    else:
+        storage = MemoryStorage(main)
+        storage.install()
+
+    main.MODERATION_CHAT_ID = MOD_CHAT_ID
+    main.LABELS[:] = make_labels(args)
+    await main.init_http()
+    await main.warm_seen_filter()
+
+    feeds = main.plan_feeds(main.LABELS)
+    cycle_times, fetched_posts = [], 0
+    try:
+        started = time.perf_counter()
+        for _ in range(args.cycles):
+            booru.publish(args.posts)
+            t0 = time.perf_counter()
+            await main.run_parser_cycle(feeds)
+            cycle_times.append(time.perf_counter() - t0)
+            fetched_posts += args.posts * args.base_tags
+        parser_elapsed = time.perf_counter() - started
+        parser_round_trips = storage.round_trips
+
+        callback_times = await press_queue_buttons(main, tg, args.callbacks)
+        queue_time = await send_queue_command(main)
+    finally:
+        await main.close_http()
+        await main.bot.session.close()
+        if main.storage:
+            await main.storage.close()
+        if args.database_url:
+            await admin.execute(f"DROP SCHEMA {schema} CASCADE;")
+            await admin.close()
+        await booru_runner.cleanup()
+        await tg_runner.cleanup()
+        shutil.rmtree(cache_dir, ignore_errors=True)
+        shutil.rmtree(db_dir, ignore_errors=True)
+
+    cards = tg.calls["sendphoto"]
+    rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    print(f"Лент: {len(feeds)} на {len(main.LABELS)} лейблов, проходов: {args.cycles}, хранилище: {'Postgres' if args.database_url else 'SQLite' if args.sqlite else 'память'}")
+    print(f"Постов опубликовано бурой: {fetched_posts}, запросов к буре: {booru.requests['index']} (429: {booru.requests['429']}), превью: {booru.requests['image']}")
+    print(f"Пропускная способность парсера: {fetched_posts / parser_elapsed:.1f} постов/сек")
+    print(f"Проход парсера: p50 {percentile(cycle_times, 50) * 1000:.0f} мс, p95 {percentile(cycle_times, 95) * 1000:.0f} мс, max {max(cycle_times) * 1000:.0f} мс")
+    print(f"Обращений к базе на пост: {parser_round_trips / max(fetched_posts, 1):.2f} ({parser_round_trips} всего)")
+    print(f"Карточек модерации: {cards}, вызовов Bot API: {sum(v for k, v in tg.calls.items() if k not in ('429', 'url_fail', 'upload'))} (429: {tg.calls['429']})")
+    if args.tg_url_fail:
+        print(f"Ссылок не скачано Telegram: {tg.calls['url_fail']}, загружено файлом из кэша: {tg.calls['upload']}")
+    if callback_times:
+        print(f"Кнопка «В очередь»: p50 {percentile(callback_times, 50) * 1000:.1f} мс, p95 {percentile(callback_times, 95) * 1000:.1f} мс")
+    print(f"/queue: {queue_time * 1000:.0f} мс")
+    print(f"Пиковый RSS: {rss_mb:.0f} МБ")
+
+if __name__ == "__main__":
+    asyncio.run(run(parse_args()))
@@ -1,18 +1,41 @@
 import os
 import sys
+import time
 import asyncio
 import json
+import math
+import heapq
+import hashlib
+import functools
+import itertools
+import threading
 import logging
+import socket
+import sqlite3
+from io import BytesIO
+from collections import OrderedDict
+from datetime import date, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlsplit
 import asyncpg
 import aiohttp
+import aiofiles
 from aiogram import Bot, Dispatcher, types, F
 from aiogram.types import (
     Message, BotCommand, InlineKeyboardMarkup, InlineKeyboardButton, 
-    CallbackQuery, BufferedInputFile
+    CallbackQuery, BufferedInputFile, InputMediaPhoto
 )
+from aiogram.exceptions import TelegramRetryAfter, TelegramBadRequest
 from aiogram.client.default import DefaultBotProperties
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 from aiogram.enums import ParseMode
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler
 from dotenv import load_dotenv
+from PIL import Image
+from aiohttp import web
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
 
 load_dotenv()
 
@@ -27,12 +50,18 @@ logger = logging.getLogger(__name__)
 # --- КОНФИГУРАЦИЯ ---
 TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_URL = os.getenv("DATABASE_URL")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "bot.db")  # без DATABASE_URL всё хранится здесь
 
 R34_USER_ID = os.getenv("R34_USER_ID", "").strip()
 R34_API_KEY = os.getenv("R34_API_KEY", "").strip()
 GELBOORU_USER_ID = os.getenv("GELBOORU_USER_ID", "").strip()
 GELBOORU_API_KEY = os.getenv("GELBOORU_API_KEY", "").strip()
 
+# Адреса API можно переопределить (локальный Bot API сервер, стенды бенчмарка)
+R34_API_URL = os.getenv("R34_API_URL", "https://api.rule34.xxx/index.php")
+GELBOORU_API_URL = os.getenv("GELBOORU_API_URL", "https://gelbooru.com/index.php")
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL")
+
 ALLOWED_USERS = []
 for i in range(1, 4):
     uid = os.getenv(f"ALLOWED_USER_{i}")
@@ -52,26 +81,259 @@ PARSER_ENABLED = True
 PARSER_SPEED = 15
 PARSER_LIMIT = 20
 LABELS = []
-
-db_pool = None
-post_metadata_store = {}  # Временное хранение метаданных сообщений модерации
-
-bot = Bot(token=TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+PARSER_CURSORS = {}  # (источник, теги) -> id самого нового уже обработанного поста
+
+# Лимиты запросов к бурам (на один хост)
+BOORU_RPS = float(os.getenv("BOORU_RPS", "2"))
+BOORU_BURST = int(os.getenv("BOORU_BURST", "2"))
+BOORU_MAX_RETRIES = 2
+
+# Параллельность парсера
+PARSER_CONCURRENCY = int(os.getenv("PARSER_CONCURRENCY", "4"))  # одновременных выборок (лейбл, источник)
+PARSER_PAGE_BUFFER = int(os.getenv("PARSER_PAGE_BUFFER", "2"))  # страниц ленты, выбранных наперёд, пока идёт обработка
+PARSER_FETCH_TIMEOUT = 60
+PARSER_MAX_PAGES = int(os.getenv("PARSER_MAX_PAGES", "5"))  # сколько страниц новых постов догонять за проход
+PARSER_MAX_INTERVAL = int(os.getenv("PARSER_MAX_INTERVAL", "1800"))  # самый редкий опрос тихой ленты, сек.
+PARSER_BUDGET_PER_MIN = int(os.getenv("PARSER_BUDGET_PER_MIN", "60"))  # запросов к бурам в минуту на всех
+PARSER_COALESCE = os.getenv("PARSER_COALESCE", "1") == "1"  # объединять похожие запросы лейблов
+
+# Лимиты исходящих сообщений Telegram
+TG_GLOBAL_RPS = 25
+TG_PRIVATE_RPS = 1.0
+TG_GROUP_RPS = 20 / 60
+TG_GROUP_BURST = 3
+TG_MAX_RETRIES = 3
+PRIORITY_INTERACTIVE = 0  # ответы на команды и кнопки
+PRIORITY_BULK = 1  # карточки модерации
+
+# Поиск похожих артов по перцептивному хешу превью
+PHASH_ENABLED = os.getenv("PHASH_ENABLED", "1") == "1"
+PHASH_MAX_DISTANCE = int(os.getenv("PHASH_MAX_DISTANCE", "6"))  # бит из 64
+PHASH_WORKERS = 2
+PHASH_INDEX_SIZE = int(os.getenv("PHASH_INDEX_SIZE", "100000"))  # хешей в памяти для поиска похожих (~50 МБ на 100 тыс.)
+
+# HTTP-сервер (health, /metrics)
+WEB_PORT = int(os.getenv("PORT", "8080"))
+PROFILER_ENABLED = os.getenv("PROFILER_ENABLED", "0") == "1"  # открывает /debug/profile
+
+# Вебхук вместо long polling: WEBHOOK_URL — публичный адрес сервиса (например, https://bot.onrender.com)
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip().rstrip("/")
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+# Telegram присылает секрет в X-Telegram-Bot-Api-Secret-Token; по умолчанию выводим его из токена
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or hashlib.sha256(f"webhook:{TOKEN}".encode()).hexdigest()
+
+# Локальный кэш файлов с бур: когда Telegram не может забрать ссылку, грузим байты сами
+MEDIA_CACHE_DIR = os.getenv("MEDIA_CACHE_DIR", "media_cache")
+MEDIA_CACHE_MAX_MB = int(os.getenv("MEDIA_CACHE_MAX_MB", "512"))
+MEDIA_MAX_DOWNLOAD_MB = 50
+MEDIA_DOWNLOAD_TIMEOUT = 60
+MEDIA_CHUNK_SIZE = 64 * 1024
+MEDIA_DOWNSCALE = os.getenv("MEDIA_DOWNSCALE", "1") == "1"
+MEDIA_MAX_SIDE = 2560  # больше Telegram всё равно не показывает
+TG_PHOTO_MAX_BYTES = 10 * 1024 * 1024  # лимит sendPhoto на загрузку
+
+# Метаданные карточек модерации
+MOD_STORE_SIZE = int(os.getenv("MOD_STORE_SIZE", "2000"))  # записей в памяти
+MOD_STORE_TTL_DAYS = int(os.getenv("MOD_STORE_TTL_DAYS", "14"))
+
+# Фильтр уже виденных постов перед таблицей seen_posts
+SEEN_FILTER_CAPACITY = int(os.getenv("SEEN_FILTER_CAPACITY", "200000"))
+SEEN_FILTER_ERROR = 0.01
+SEEN_LRU_SIZE = int(os.getenv("SEEN_LRU_SIZE", "20000"))
+
+# seen_posts разбита на месячные партиции; хеши (md5, pHash) живут отдельно в seen_hashes без срока
+SEEN_RETENTION_DAYS = int(os.getenv("SEEN_RETENTION_DAYS", "60"))
+SEEN_PARTITIONS_AHEAD = 1  # партиций наперёд, чтобы вставка не упала на смене месяца
+SEEN_CLAIM_LOCK = 0x5EE5  # пространство advisory-блокировок (source, post_id) при вставке в seen_posts
+SEEN_MAINTENANCE_INTERVAL = 3600
+SEEN_LOCK_TIMEOUT_MS = 2000
+SEEN_MAINTENANCE_LOCK = 0x5EE4  # ключ advisory-блокировки: обслуживание делает один экземпляр
+
+# Несколько экземпляров делят ленты парсера через аренду в feed_leases.
+# Больше одного экземпляра — только в режиме вебхука: getUpdates отдаёт апдейты одному клиенту.
+INSTANCE_ID = os.getenv("INSTANCE_ID") or f"{socket.gethostname()}-{os.getpid()}"
+INSTANCE_HEARTBEAT = 10  # сек. между пульсами и перераспределением лент
+INSTANCE_TTL = 30  # экземпляр без пульса дольше этого считается упавшим
+LEASE_TTL = 30
+CONFIG_CHANNEL = "parser_config"  # NOTIFY при изменении лейблов и группы модерации
+SCHEMA_LOCK = 0x5C4E  # advisory-блокировка на время init_db
+
+storage = None  # PostgresStorage или SqliteStorage, выбирается в init_db()
+http_session = None  # Общий пул keep-alive соединений, создаётся в main()
+host_limiters = {}
+
+bot = Bot(
+    token=TOKEN,
+    default=DefaultBotProperties(parse_mode=ParseMode.HTML),
+    session=AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL)) if TELEGRAM_API_URL else None
+)
 dp = Dispatcher()
 
-# --- DATABASE (POSTGRESQL) ---
-
-async def init_db():
-    global db_pool
-    if not DATABASE_URL:
-        logger.warning("⚠️ DATABASE_URL не указан. База данных отключена.")
+# --- МЕТРИКИ ---
+
+FETCH_SECONDS = Histogram("booru_fetch_seconds", "Длительность HTTP-запроса fetch_booru_posts", ["source", "result"])
+BOORU_429 = Counter("booru_rate_limited_total", "Ответы 429 от бур", ["source"])
+DB_SECONDS = Histogram("db_query_seconds", "Длительность запросов к базе по хелперам", ["helper"])
+TG_SECONDS = Histogram("telegram_request_seconds", "Длительность запросов к Bot API", ["method"])
+TG_RETRY_AFTER = Counter("telegram_retry_after_total", "Флуд-лимиты (429) от Telegram", ["method"])
+CYCLE_SECONDS = Histogram("parser_cycle_seconds", "Длительность опроса ленты с обработкой её страниц", buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600))
+QUEUE_DEPTH = Gauge("publish_queue_depth", "Постов в очереди публикаций")
+SEEN_CHECKS = Counter("seen_filter_checks_total", "Ответы фильтра виденных постов", ["result"])
+DEDUP_POSTS = Counter("dedup_posts_total", "Итог дедупликации выбранных постов", ["outcome"])
+MEDIA_CACHE_REQUESTS = Counter("media_cache_requests_total", "Обращения к локальному кэшу медиа", ["result"])
+
+def db_timed(func):
+    """Пишет длительность хелпера базы в db_query_seconds{helper=имя функции}."""
+    histogram = DB_SECONDS.labels(func.__name__)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with histogram.time():
+            return await func(*args, **kwargs)
+    return wrapper
+
+# --- ХРАНИЛИЩЕ (POSTGRESQL ИЛИ ВСТРОЕННАЯ SQLITE) ---
+
+def database_dsn() -> str:
+    return DATABASE_URL.replace("postgres://", "postgresql://", 1) if DATABASE_URL.startswith("postgres://") else DATABASE_URL
+
+# Партиция — seen_posts_pYYYYMM за один месяц seen_on: поиск поста за SEEN_RETENTION_DAYS
+# задевает индексы трёх-четырёх партиций. Ключ (source, post_id, seen_on) не мешает вставить
+# тот же пост в другой день, поэтому insert_seen_posts проверяет все партиции под блокировкой поста.
+SEEN_POSTS_DDL = """
+    CREATE TABLE IF NOT EXISTS seen_posts (
+        source VARCHAR(20) NOT NULL,
+        post_id BIGINT NOT NULL,
+        seen_on DATE NOT NULL DEFAULT CURRENT_DATE,
+        PRIMARY KEY (source, post_id, seen_on)
+    ) PARTITION BY RANGE (seen_on);
+"""
+
+def next_month(month: date) -> date:
+    return (month.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def seen_partition_name(month: date) -> str:
+    return f"seen_posts_p{month:%Y%m}"
+
+def seen_partition_month(name: str):
+    suffix = name[len("seen_posts_p"):] if name.startswith("seen_posts_p") else ""
+    if len(suffix) != 6 or not suffix.isdigit(): return None
+    try:
+        return date(int(suffix[:4]), int(suffix[4:]), 1)
+    except ValueError:
+        return None
+
+async def ensure_seen_partitions(conn, first_day: date = None) -> date:
+    """Создаёт месячные партиции с месяца first_day (по умолчанию вчера) на SEEN_PARTITIONS_AHEAD месяцев вперёд.
+
+    Дата берётся у базы: DEFAULT CURRENT_DATE считается в её часовом поясе.
+    """
+    today = await conn.fetchval("SELECT CURRENT_DATE;")
+    month = (first_day or today - timedelta(days=1)).replace(day=1)
+    last = today.replace(day=1)
+    for _ in range(SEEN_PARTITIONS_AHEAD):
+        last = next_month(last)
+    while month <= last:
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {seen_partition_name(month)} PARTITION OF seen_posts
+            FOR VALUES FROM ('{month}') TO ('{next_month(month)}');
+        """)
+        month = next_month(month)
+    return today
+
+async def migrate_seen_posts(conn):
+    """Создаёт партиционированную seen_posts; старую таблицу переносит разово.
+
+    Из обычной таблицы посты моложе SEEN_RETENTION_DAYS переезжают в партиции,
+    md5 и pHash всех постов — в seen_hashes. Таблица с дневными партициями
+    перекладывается в месячные.
+    """
+    kind = await conn.fetchval("SELECT relkind::text FROM pg_class WHERE oid = to_regclass('seen_posts');")
+    if kind is None:
+        await conn.execute(SEEN_POSTS_DDL)
+        return
+    if kind == "p":
+        await migrate_daily_seen_partitions(conn)
         return
 
-    url = DATABASE_URL.replace("postgres://", "postgresql://", 1) if DATABASE_URL.startswith("postgres://") else DATABASE_URL
-
-    try:
-        db_pool = await asyncpg.create_pool(dsn=url)
-        async with db_pool.acquire() as conn:
+    async with conn.transaction():
+        await conn.execute("""
+            ALTER TABLE seen_posts RENAME TO seen_posts_legacy;
+            ALTER TABLE seen_posts_legacy RENAME CONSTRAINT seen_posts_pkey TO seen_posts_legacy_pkey;
+            -- phash появился в seen_posts позже, в базах со старой схемой его ещё нет
+            ALTER TABLE seen_posts_legacy ADD COLUMN IF NOT EXISTS phash BIGINT;
+        """)
+        await conn.execute(SEEN_POSTS_DDL)
+        first_day = await conn.fetchval("""
+            SELECT GREATEST(min(created_at)::date, CURRENT_DATE - $1::int) FROM seen_posts_legacy;
+        """, SEEN_RETENTION_DAYS)
+        await ensure_seen_partitions(conn, first_day)
+        moved = await conn.fetchval("""
+            WITH moved AS (
+                INSERT INTO seen_posts (source, post_id, seen_on)
+                SELECT source, post_id::bigint, created_at::date FROM seen_posts_legacy
+                WHERE post_id ~ '^[0-9]+$' AND created_at >= CURRENT_DATE - $1::int
+                ON CONFLICT DO NOTHING RETURNING 1
+            ) SELECT count(*) FROM moved;
+        """, SEEN_RETENTION_DAYS)
+        await conn.execute("""
+            INSERT INTO seen_hashes (source, post_id, md5, phash, created_at)
+            SELECT source, post_id::bigint,
+                   CASE WHEN file_md5 ~ '^[0-9a-fA-F]{32}$' THEN decode(file_md5, 'hex') END, phash, created_at
+            FROM seen_posts_legacy
+            WHERE post_id ~ '^[0-9]+$' AND (file_md5 IS NOT NULL OR phash IS NOT NULL)
+            ON CONFLICT DO NOTHING;
+            DROP TABLE seen_posts_legacy;
+        """)
+    logger.info(f"✅ seen_posts переведена на месячные партиции, перенесено {moved} постов.")
+
+async def migrate_daily_seen_partitions(conn):
+    """Перекладывает seen_posts с дневных партиций seen_posts_pYYYYMMDD на месячные."""
+    daily = await conn.fetchval("""
+        SELECT count(*) FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'seen_posts'::regclass AND c.relname ~ '^seen_posts_p[0-9]{8}$';
+    """)
+    if not daily: return
+    async with conn.transaction():
+        await conn.execute("""
+            ALTER TABLE seen_posts RENAME TO seen_posts_daily;
+            ALTER TABLE seen_posts_daily RENAME CONSTRAINT seen_posts_pkey TO seen_posts_daily_pkey;
+        """)
+        await conn.execute(SEEN_POSTS_DDL)
+        await ensure_seen_partitions(conn, await conn.fetchval("SELECT min(seen_on) FROM seen_posts_daily;"))
+        moved = await conn.fetchval("""
+            WITH moved AS (
+                INSERT INTO seen_posts (source, post_id, seen_on)
+                SELECT DISTINCT ON (source, post_id) source, post_id, seen_on FROM seen_posts_daily
+                ORDER BY source, post_id, seen_on
+                ON CONFLICT DO NOTHING RETURNING 1
+            ) SELECT count(*) FROM moved;
+        """)
+        await conn.execute("DROP TABLE seen_posts_daily;")
+    logger.info(f"✅ Дневные партиции seen_posts ({daily}) объединены в месячные, перенесено {moved} постов.")
+
+class PostgresStorage:
+    """Хранилище на PostgreSQL через пул asyncpg.
+
+    Базу могут делить несколько экземпляров бота (shared): кроме данных здесь
+    пульс экземпляров, аренда лент и LISTEN/NOTIFY об изменении лейблов.
+    """
+
+    shared = True
+
+    def __init__(self, dsn: str):
+        self.dsn = dsn
+        self.name = "PostgreSQL"
+        self.pool = None
+
+    async def connect(self):
+        self.pool = await asyncpg.create_pool(dsn=self.dsn)
+
+    async def init_schema(self):
+        async with self.pool.acquire() as conn:
+            # Экземпляры, стартующие одновременно, создают схему по очереди; asyncpg снимает
+            # блокировку сам, когда соединение возвращается в пул
+            await conn.execute("SELECT pg_advisory_lock($1);", SCHEMA_LOCK)
             await conn.execute("""
                 CREATE TABLE IF NOT EXISTS parser_config (
                     id INT PRIMARY KEY DEFAULT 1,
@@ -80,148 +342,1558 @@ async def init_db():
                     queue JSONB NOT NULL DEFAULT '[]'::jsonb,
                     updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 );
-                CREATE TABLE IF NOT EXISTS seen_posts (
+                CREATE TABLE IF NOT EXISTS seen_hashes (
                     source VARCHAR(20) NOT NULL,
-                    post_id VARCHAR(50) NOT NULL,
-                    file_md5 VARCHAR(64),
+                    post_id BIGINT NOT NULL,
+                    md5 BYTEA,
+                    phash BIGINT,
                     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
                     PRIMARY KEY (source, post_id)
                 );
+                CREATE INDEX IF NOT EXISTS seen_hashes_md5_idx ON seen_hashes (md5);
+                CREATE TABLE IF NOT EXISTS parser_cursors (
+                    source VARCHAR(20) NOT NULL,
+                    tags TEXT NOT NULL,
+                    last_post_id BIGINT NOT NULL DEFAULT 0,
+                    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (source, tags)
+                );
+                ALTER TABLE parser_cursors ADD COLUMN IF NOT EXISTS poll_interval DOUBLE PRECISION;
+                ALTER TABLE parser_cursors ADD COLUMN IF NOT EXISTS next_poll_at DOUBLE PRECISION;
+                ALTER TABLE parser_cursors ADD COLUMN IF NOT EXISTS post_rate DOUBLE PRECISION;
+                CREATE TABLE IF NOT EXISTS mod_cards (
+                    chat_id BIGINT NOT NULL,
+                    message_id BIGINT NOT NULL,
+                    meta JSONB NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (chat_id, message_id)
+                );
+                CREATE INDEX IF NOT EXISTS mod_cards_created_at_idx ON mod_cards (created_at);
+                CREATE TABLE IF NOT EXISTS publish_queue (
+                    id BIGSERIAL PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    type VARCHAR(20) NOT NULL DEFAULT 'photo',
+                    caption TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                -- file_id — то, что отдаём Telegram: его file_id, пока он не известен — ссылка на буру
+                ALTER TABLE publish_queue ADD COLUMN IF NOT EXISTS file_url TEXT;
+                ALTER TABLE publish_queue ADD COLUMN IF NOT EXISTS post_key TEXT;
+                CREATE INDEX IF NOT EXISTS publish_queue_post_key_idx ON publish_queue (post_key);
+                UPDATE publish_queue SET file_url = file_id WHERE file_url IS NULL AND file_id LIKE 'http%';
+                CREATE TABLE IF NOT EXISTS media_file_ids (
+                    post_key TEXT PRIMARY KEY,
+                    file_id TEXT NOT NULL,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                );
+                CREATE TABLE IF NOT EXISTS parser_instances (
+                    instance_id TEXT PRIMARY KEY,
+                    started_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    heartbeat_at TIMESTAMP NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS feed_leases (
+                    source VARCHAR(20) NOT NULL,
+                    tags TEXT NOT NULL,
+                    owner TEXT NOT NULL,
+                    expires_at TIMESTAMP NOT NULL,
+                    PRIMARY KEY (source, tags)
+                );
+            """)
+            # Разовый перенос старой очереди из JSONB-массива parser_config.queue
+            await conn.execute("""
+                INSERT INTO publish_queue (file_id, type, caption)
+                SELECT q.item->>'file_id', COALESCE(q.item->>'type', 'photo'), q.item->>'caption'
+                FROM parser_config, jsonb_array_elements(parser_config.queue) WITH ORDINALITY AS q(item, n)
+                WHERE parser_config.id = 1 AND q.item->>'file_id' IS NOT NULL
+                ORDER BY q.n;
+                UPDATE parser_config SET queue = '[]'::jsonb WHERE id = 1 AND queue <> '[]'::jsonb;
+            """)
+            await migrate_seen_posts(conn)
+            await ensure_seen_partitions(conn)
+
+    async def close(self):
+        if self.pool:
+            await self.pool.close()
+
+    async def listen(self, channel: str, callback):
+        """Отдельное соединение, подписанное на channel; пул для LISTEN не подходит."""
+        conn = await asyncpg.connect(dsn=self.dsn)
+        try:
+            await conn.add_listener(channel, callback)
+        except BaseException:
+            await conn.close()
+            raise
+        return conn
+
+    async def load_state(self):
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("SELECT mod_chat_id, labels FROM parser_config WHERE id = 1;")
+        if not row: return None
+        lbls = row["labels"]
+        return row["mod_chat_id"], json.loads(lbls) if isinstance(lbls, str) else (lbls or [])
+
+    async def save_state(self, mod_chat_id, labels: list):
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO parser_config (id, mod_chat_id, labels, updated_at)
+                VALUES (1, $1, $2::jsonb, CURRENT_TIMESTAMP)
+                ON CONFLICT (id) DO UPDATE
+                SET mod_chat_id = EXCLUDED.mod_chat_id, labels = EXCLUDED.labels, updated_at = CURRENT_TIMESTAMP;
+            """, mod_chat_id, json.dumps(labels, ensure_ascii=False))
+            # Остальные экземпляры перечитают состояние по уведомлению
+            await conn.execute("SELECT pg_notify($1, $2);", CONFIG_CHANNEL, INSTANCE_ID)
+
+    async def load_cursors(self, keys: list = None) -> list:
+        query = "SELECT source, tags, last_post_id, poll_interval, next_poll_at, post_rate FROM parser_cursors"
+        async with self.pool.acquire() as conn:
+            if keys is None:
+                return await conn.fetch(query + ";")
+            return await conn.fetch(
+                query + " WHERE (source, tags) IN (SELECT * FROM unnest($1::text[], $2::text[]));",
+                [k[0] for k in keys], [k[1] for k in keys]
+            )
+
+    async def advance_cursor(self, source: str, tags: str, last_post_id: int):
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO parser_cursors (source, tags, last_post_id, updated_at)
+                VALUES ($1, $2, $3, CURRENT_TIMESTAMP)
+                ON CONFLICT (source, tags) DO UPDATE
+                SET last_post_id = GREATEST(parser_cursors.last_post_id, EXCLUDED.last_post_id), updated_at = CURRENT_TIMESTAMP;
+            """, source, tags, last_post_id)
+
+    async def save_poll_state(self, key: tuple, state: dict):
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO parser_cursors (source, tags, poll_interval, next_poll_at, post_rate, updated_at)
+                VALUES ($1, $2, $3, $4, $5, CURRENT_TIMESTAMP)
+                ON CONFLICT (source, tags) DO UPDATE
+                SET poll_interval = EXCLUDED.poll_interval, next_poll_at = EXCLUDED.next_poll_at,
+                    post_rate = EXCLUDED.post_rate, updated_at = CURRENT_TIMESTAMP;
+            """, *key, state["interval"], state["next_at"], state["rate"])
+
+    async def enqueue_post(self, file_id: str, caption: str, media_type: str, file_url: str, post_key: str):
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("""
+                INSERT INTO publish_queue (file_id, type, caption, file_url, post_key)
+                VALUES (COALESCE((SELECT file_id FROM media_file_ids WHERE post_key = $5), $1), $2, $3, $4, $5)
+                RETURNING id;
+            """, file_id, media_type, caption, file_url, post_key)
+
+    async def save_file_id(self, post_key: str, file_id: str):
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                WITH saved AS (
+                    INSERT INTO media_file_ids (post_key, file_id) VALUES ($1, $2)
+                    ON CONFLICT (post_key) DO UPDATE SET file_id = EXCLUDED.file_id
+                )
+                UPDATE publish_queue SET file_id = $2 WHERE post_key = $1 AND file_id <> $2;
+            """, post_key, file_id)
+
+    async def dequeue_post(self, item_id: int = None):
+        async with self.pool.acquire() as conn:
+            if item_id is None:
+                row = await conn.fetchrow("""
+                    DELETE FROM publish_queue WHERE id = (
+                        SELECT id FROM publish_queue ORDER BY id FOR UPDATE SKIP LOCKED LIMIT 1
+                    ) RETURNING *;
+                """)
+            else:
+                row = await conn.fetchrow("DELETE FROM publish_queue WHERE id = $1 RETURNING *;", item_id)
+        return dict(row) if row else None
+
+    async def get_queue_page(self, after_id: int, limit: int) -> list:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("SELECT * FROM publish_queue WHERE id > $1 ORDER BY id LIMIT $2;", after_id, limit)
+        return [dict(r) for r in rows]
+
+    async def get_queue_size(self) -> int:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("SELECT count(*) FROM publish_queue;")
+
+    async def save_mod_card(self, chat_id: int, message_id: int, meta: dict, purge_ttl: float = None):
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO mod_cards (chat_id, message_id, meta) VALUES ($1, $2, $3::jsonb)
+                ON CONFLICT (chat_id, message_id) DO UPDATE SET meta = EXCLUDED.meta;
+            """, chat_id, message_id, json.dumps(meta, ensure_ascii=False))
+            if purge_ttl:
+                await conn.execute(
+                    "DELETE FROM mod_cards WHERE created_at < CURRENT_TIMESTAMP - make_interval(secs => $1);", purge_ttl
+                )
+
+    async def load_mod_card(self, chat_id: int, message_id: int, ttl: float):
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT meta, extract(epoch FROM LOCALTIMESTAMP - created_at) AS age FROM mod_cards
+                WHERE chat_id = $1 AND message_id = $2
+                  AND created_at >= CURRENT_TIMESTAMP - make_interval(secs => $3);
+            """, chat_id, message_id, ttl)
+        if not row: return None
+        meta = json.loads(row["meta"]) if isinstance(row["meta"], str) else row["meta"]
+        return meta, float(row["age"])
+
+    async def delete_mod_card(self, chat_id: int, message_id: int):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM mod_cards WHERE chat_id = $1 AND message_id = $2;", chat_id, message_id)
+
+    async def seen_posts(self):
+        """Все посты истории (source, post_id) от старых к новым, курсором без загрузки целиком."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                query = "SELECT source, post_id::text AS post_id FROM seen_posts ORDER BY seen_on;"
+                async for row in conn.cursor(query, prefetch=5000):
+                    yield row
+
+    async def seen_hashes(self):
+        """Все хеши (source, post_id, file_md5 в hex, phash) от старых к новым."""
+        async with self.pool.acquire() as conn:
+            async with conn.transaction():
+                query = """
+                    SELECT source, post_id::text AS post_id, encode(md5, 'hex') AS file_md5, phash
+                    FROM seen_hashes ORDER BY created_at;
+                """
+                async for row in conn.cursor(query, prefetch=5000):
+                    yield row
+
+    async def classify_posts(self, source: str, unknown: list) -> dict:
+        """Одним запросом: виден ли каждый пост из [(post_id, md5)] и первый пост с тем же md5."""
+        async with self.pool.acquire() as conn:
+            return {r["post_id"]: r for r in await conn.fetch("""
+                SELECT b.post_id,
+                       EXISTS (
+                           SELECT 1 FROM seen_posts s WHERE s.source = $1 AND s.post_id = b.post_id::bigint
+                             AND s.seen_on BETWEEN CURRENT_DATE - $4::int AND CURRENT_DATE
+                       ) AS seen,
+                       d.source AS dup_source, d.post_id::text AS dup_post_id
+                FROM unnest($2::text[], $3::text[]) AS b(post_id, file_md5)
+                LEFT JOIN LATERAL (
+                    SELECT h.source, h.post_id FROM seen_hashes h WHERE h.md5 = decode(b.file_md5, 'hex') LIMIT 1
+                ) d ON TRUE;
+            """, source, [u[0] for u in unknown], [u[1] for u in unknown], SEEN_RETENTION_DAYS)}
+
+    async def insert_seen_posts(self, source: str, fresh: list) -> set:
+        """Пакетно записывает [(пост, post_id, md5, дубликат)]; возвращает реально вставленные post_id.
+
+        Первичный ключ партиций включает seen_on и не мешает другому экземпляру
+        вставить тот же пост в другой день. Поэтому посты блокируются по
+        (source, post_id) до конца транзакции, в порядке ключей, чтобы не было
+        взаимоблокировок, и вставляются, только если их нет ни в одной партиции
+        за SEEN_RETENTION_DAYS.
+        """
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute("""
+                SELECT pg_advisory_xact_lock($1, k) FROM (
+                    SELECT DISTINCT hashtext($2 || ':' || id) AS k FROM unnest($3::text[]) AS id
+                ) keys ORDER BY k;
+            """, SEEN_CLAIM_LOCK, source, [f[1] for f in fresh])
+            # Пустой RETURNING значит, что пост уже забрал другой воркер или экземпляр
+            inserted = await conn.fetch("""
+                WITH claimed AS (
+                    INSERT INTO seen_posts (source, post_id)
+                    SELECT $1, b.post_id FROM unnest($2::text[]::bigint[]) AS b(post_id)
+                    WHERE NOT EXISTS (
+                        SELECT 1 FROM seen_posts s WHERE s.source = $1::varchar AND s.post_id = b.post_id
+                          AND s.seen_on BETWEEN CURRENT_DATE - $4::int AND CURRENT_DATE
+                    )
+                    ON CONFLICT DO NOTHING RETURNING post_id
+                ), hashes AS (
+                    INSERT INTO seen_hashes (source, post_id, md5)
+                    SELECT $1, c.post_id, decode(b.file_md5, 'hex')
+                    FROM claimed c JOIN unnest($2::text[], $3::text[]) AS b(post_id, file_md5) ON b.post_id::bigint = c.post_id
+                    WHERE b.file_md5 IS NOT NULL
+                    ON CONFLICT DO NOTHING
+                )
+                SELECT post_id::text AS post_id FROM claimed;
+            """, source, [f[1] for f in fresh], [f[2] for f in fresh], SEEN_RETENTION_DAYS)
+        return {r["post_id"] for r in inserted}
+
+    async def save_phashes(self, source: str, rows: list):
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                INSERT INTO seen_hashes (source, post_id, phash)
+                SELECT $1, u.post_id::bigint, u.phash FROM unnest($2::text[], $3::bigint[]) AS u(post_id, phash)
+                ON CONFLICT (source, post_id) DO UPDATE SET phash = EXCLUDED.phash;
+            """, source, [r[0] for r in rows], [r[1] for r in rows])
+
+    async def maintain_seen_posts(self):
+        """Создаёт партиции наперёд и удаляет целиком вышедшие за SEEN_RETENTION_DAYS.
+
+        DETACH ... CONCURRENTLY не блокирует вставки парсера, а lock_timeout не даёт
+        ему повиснуть в очереди блокировок, если таблица занята. Прерванный detach
+        доделывается через FINALIZE на следующем проходе.
+        """
+        async with self.pool.acquire() as conn:
+            # Другой экземпляр уже обслуживает таблицу — пропускаем проход
+            if not await conn.fetchval("SELECT pg_try_advisory_lock($1);", SEEN_MAINTENANCE_LOCK): return
+            try:
+                today = await ensure_seen_partitions(conn)
+                cutoff = today - timedelta(days=SEEN_RETENTION_DAYS)
+                partitions = await conn.fetch("""
+                    SELECT c.relname, i.inhdetachpending FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid
+                    WHERE i.inhparent = 'seen_posts'::regclass ORDER BY c.relname;
+                """)
+                for part in partitions:
+                    month = seen_partition_month(part["relname"])
+                    # Партиция уходит целиком, когда из срока вышел её последний день
+                    if month is None or next_month(month) > cutoff: continue
+                    name = part["relname"]
+                    await conn.execute(f"SET lock_timeout = {SEEN_LOCK_TIMEOUT_MS};")
+                    try:
+                        mode = "FINALIZE" if part["inhdetachpending"] else "CONCURRENTLY"
+                        await conn.execute(f"ALTER TABLE seen_posts DETACH PARTITION {name} {mode};")
+                        await conn.execute(f"DROP TABLE {name};")
+                        logger.info(f"🧹 Удалена партиция {name} (старше {SEEN_RETENTION_DAYS} дн.)")
+                    except asyncpg.PostgresError as e:
+                        logger.warning(f"⚠️ Партиция {name} не удалена, повторим позже: {e}")
+                    finally:
+                        await conn.execute("RESET lock_timeout;")
+                # file_id постов, которые уже не в очереди, живут столько же, сколько история постов
+                await conn.execute("""
+                    DELETE FROM media_file_ids m
+                    WHERE m.created_at < CURRENT_TIMESTAMP - make_interval(days => $1)
+                      AND NOT EXISTS (SELECT 1 FROM publish_queue q WHERE q.post_key = m.post_key);
+                """, SEEN_RETENTION_DAYS)
+            finally:
+                await conn.execute("SELECT pg_advisory_unlock($1);", SEEN_MAINTENANCE_LOCK)
+
+    async def heartbeat_instance(self) -> list:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                WITH beat AS (
+                    INSERT INTO parser_instances (instance_id, heartbeat_at) VALUES ($1, CURRENT_TIMESTAMP)
+                    ON CONFLICT (instance_id) DO UPDATE SET heartbeat_at = EXCLUDED.heartbeat_at
+                ), gone AS (
+                    DELETE FROM parser_instances
+                    WHERE heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => $2 * 10) AND instance_id <> $1
+                )
+                SELECT instance_id FROM parser_instances
+                WHERE heartbeat_at >= CURRENT_TIMESTAMP - make_interval(secs => $2)
+                UNION SELECT $1;
+            """, INSTANCE_ID, INSTANCE_TTL)
+        return sorted(r["instance_id"] for r in rows)
+
+    async def sync_feed_leases(self, feeds: list) -> set:
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                WITH wanted AS (
+                    SELECT * FROM unnest($2::text[], $3::text[]) AS f(source, tags)
+                ), released AS (
+                    DELETE FROM feed_leases l
+                    WHERE (l.owner = $1 OR l.expires_at < CURRENT_TIMESTAMP - make_interval(secs => $4 * 10))
+                      AND (l.source, l.tags) NOT IN (SELECT source, tags FROM wanted)
+                )
+                INSERT INTO feed_leases (source, tags, owner, expires_at)
+                SELECT source, tags, $1, CURRENT_TIMESTAMP + make_interval(secs => $4) FROM wanted
+                ON CONFLICT (source, tags) DO UPDATE SET owner = EXCLUDED.owner, expires_at = EXCLUDED.expires_at
+                WHERE feed_leases.owner = EXCLUDED.owner OR feed_leases.expires_at < CURRENT_TIMESTAMP
+                RETURNING source, tags;
+            """, INSTANCE_ID, [f[0] for f in feeds], [f[1] for f in feeds], LEASE_TTL)
+        return {(r["source"], r["tags"]) for r in rows}
+
+    async def release_instance(self):
+        async with self.pool.acquire() as conn:
+            await conn.execute("DELETE FROM feed_leases WHERE owner = $1;", INSTANCE_ID)
+            await conn.execute("DELETE FROM parser_instances WHERE instance_id = $1;", INSTANCE_ID)
+
+SQLITE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS parser_config (
+        id INTEGER PRIMARY KEY,
+        mod_chat_id INTEGER,
+        labels TEXT NOT NULL DEFAULT '[]',
+        updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+    CREATE TABLE IF NOT EXISTS seen_posts (
+        source TEXT NOT NULL,
+        post_id INTEGER NOT NULL,
+        seen_at REAL NOT NULL,
+        PRIMARY KEY (source, post_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS seen_posts_seen_at_idx ON seen_posts (seen_at);
+    CREATE TABLE IF NOT EXISTS seen_hashes (
+        source TEXT NOT NULL,
+        post_id INTEGER NOT NULL,
+        md5 BLOB,
+        phash INTEGER,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (source, post_id)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS seen_hashes_md5_idx ON seen_hashes (md5);
+    CREATE TABLE IF NOT EXISTS parser_cursors (
+        source TEXT NOT NULL,
+        tags TEXT NOT NULL,
+        last_post_id INTEGER NOT NULL DEFAULT 0,
+        poll_interval REAL,
+        next_poll_at REAL,
+        post_rate REAL,
+        PRIMARY KEY (source, tags)
+    );
+    CREATE TABLE IF NOT EXISTS mod_cards (
+        chat_id INTEGER NOT NULL,
+        message_id INTEGER NOT NULL,
+        meta TEXT NOT NULL,
+        created_at REAL NOT NULL,
+        PRIMARY KEY (chat_id, message_id)
+    );
+    CREATE INDEX IF NOT EXISTS mod_cards_created_at_idx ON mod_cards (created_at);
+    CREATE TABLE IF NOT EXISTS publish_queue (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        file_id TEXT NOT NULL,
+        type TEXT NOT NULL DEFAULT 'photo',
+        caption TEXT,
+        file_url TEXT,
+        post_key TEXT,
+        created_at REAL
+    );
+    CREATE INDEX IF NOT EXISTS publish_queue_post_key_idx ON publish_queue (post_key);
+    CREATE TABLE IF NOT EXISTS media_file_ids (
+        post_key TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        created_at REAL NOT NULL
+    );
+"""
+
+class SqliteStorage:
+    """Встроенная база для одного экземпляра без DATABASE_URL: те же таблицы и методы, что у PostgresStorage.
+
+    Одно соединение в режиме WAL живёт в однопоточном пуле: запросы не
+    блокируют event loop и идут строго по очереди, поэтому блокировки не нужны.
+    sqlite3 кэширует подготовленные запросы, пачки пишутся одной транзакцией.
+    Время хранится в секундах Unix. Делить файл между экземплярами нельзя,
+    поэтому пульса, аренды лент и уведомлений здесь нет.
+    """
+
+    shared = False
+
+    def __init__(self, path: str):
+        self.path = path
+        self.name = f"SQLite ({path})"
+        self.conn = None
+        self.pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+
+    async def run(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.pool, func, *args)
+
+    def _connect(self):
+        if os.path.dirname(self.path):
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=256)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode = WAL;")
+        conn.execute("PRAGMA synchronous = NORMAL;")
+        self.conn = conn
+
+    async def connect(self):
+        await self.run(self._connect)
+
+    async def init_schema(self):
+        await self.run(self.conn.executescript, SQLITE_SCHEMA)
+
+    async def close(self):
+        if self.conn:
+            await self.run(self.conn.close)
+        self.pool.shutdown(wait=False)
+
+    def _transaction(self, func, *args):
+        self.conn.execute("BEGIN IMMEDIATE;")
+        try:
+            result = func(*args)
+        except BaseException:
+            self.conn.execute("ROLLBACK;")
+            raise
+        self.conn.execute("COMMIT;")
+        return result
+
+    async def transaction(self, func, *args):
+        """func(*args) в потоке базы одной транзакцией."""
+        return await self.run(self._transaction, func, *args)
+
+    async def fetch(self, query: str, *args) -> list:
+        return await self.run(lambda: self.conn.execute(query, args).fetchall())
+
+    async def fetchrow(self, query: str, *args):
+        return await self.run(lambda: self.conn.execute(query, args).fetchone())
+
+    async def fetchval(self, query: str, *args):
+        row = await self.fetchrow(query, *args)
+        return row[0] if row else None
+
+    async def execute(self, query: str, *args):
+        await self.run(self.conn.execute, query, args)
+
+    async def cursor(self, query: str, *args, prefetch: int = 5000):
+        """Построчно отдаёт результат, подтягивая его пачками по prefetch, как курсор asyncpg."""
+        cur = await self.run(self.conn.execute, query, args)
+        while rows := await self.run(cur.fetchmany, prefetch):
+            for row in rows:
+                yield row
+
+    async def load_state(self):
+        row = await self.fetchrow("SELECT mod_chat_id, labels FROM parser_config WHERE id = 1;")
+        return (row["mod_chat_id"], json.loads(row["labels"])) if row else None
+
+    async def save_state(self, mod_chat_id, labels: list):
+        await self.execute("""
+            INSERT INTO parser_config (id, mod_chat_id, labels, updated_at) VALUES (1, ?, ?, CURRENT_TIMESTAMP)
+            ON CONFLICT (id) DO UPDATE
+            SET mod_chat_id = excluded.mod_chat_id, labels = excluded.labels, updated_at = CURRENT_TIMESTAMP;
+        """, mod_chat_id, json.dumps(labels, ensure_ascii=False))
+
+    async def load_cursors(self, keys: list = None) -> list:
+        rows = await self.fetch("SELECT source, tags, last_post_id, poll_interval, next_poll_at, post_rate FROM parser_cursors;")
+        if keys is None: return rows
+        wanted = set(keys)
+        return [r for r in rows if (r["source"], r["tags"]) in wanted]
+
+    async def advance_cursor(self, source: str, tags: str, last_post_id: int):
+        await self.execute("""
+            INSERT INTO parser_cursors (source, tags, last_post_id) VALUES (?, ?, ?)
+            ON CONFLICT (source, tags) DO UPDATE SET last_post_id = max(last_post_id, excluded.last_post_id);
+        """, source, tags, last_post_id)
+
+    async def save_poll_state(self, key: tuple, state: dict):
+        await self.execute("""
+            INSERT INTO parser_cursors (source, tags, poll_interval, next_poll_at, post_rate) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT (source, tags) DO UPDATE
+            SET poll_interval = excluded.poll_interval, next_poll_at = excluded.next_poll_at, post_rate = excluded.post_rate;
+        """, *key, state["interval"], state["next_at"], state["rate"])
+
+    async def enqueue_post(self, file_id: str, caption: str, media_type: str, file_url: str, post_key: str):
+        return await self.fetchval("""
+            INSERT INTO publish_queue (file_id, type, caption, file_url, post_key, created_at)
+            VALUES (COALESCE((SELECT file_id FROM media_file_ids WHERE post_key = ?5), ?1), ?2, ?3, ?4, ?5, ?6)
+            RETURNING id;
+        """, file_id, media_type, caption, file_url, post_key, time.time())
+
+    async def save_file_id(self, post_key: str, file_id: str):
+        def save():
+            self.conn.execute("""
+                INSERT INTO media_file_ids (post_key, file_id, created_at) VALUES (?, ?, ?)
+                ON CONFLICT (post_key) DO UPDATE SET file_id = excluded.file_id;
+            """, (post_key, file_id, time.time()))
+            self.conn.execute("UPDATE publish_queue SET file_id = ?2 WHERE post_key = ?1 AND file_id <> ?2;", (post_key, file_id))
+        await self.transaction(save)
+
+    async def dequeue_post(self, item_id: int = None):
+        if item_id is None:
+            row = await self.fetchrow("""
+                DELETE FROM publish_queue WHERE id = (SELECT min(id) FROM publish_queue) RETURNING *;
             """)
-        logger.info("✅ База данных PostgreSQL успешно инициализирована!")
+        else:
+            row = await self.fetchrow("DELETE FROM publish_queue WHERE id = ? RETURNING *;", item_id)
+        return dict(row) if row else None
+
+    async def get_queue_page(self, after_id: int, limit: int) -> list:
+        rows = await self.fetch("SELECT * FROM publish_queue WHERE id > ? ORDER BY id LIMIT ?;", after_id, limit)
+        return [dict(r) for r in rows]
+
+    async def get_queue_size(self) -> int:
+        return await self.fetchval("SELECT count(*) FROM publish_queue;")
+
+    async def save_mod_card(self, chat_id: int, message_id: int, meta: dict, purge_ttl: float = None):
+        def save():
+            now = time.time()
+            self.conn.execute("""
+                INSERT INTO mod_cards (chat_id, message_id, meta, created_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (chat_id, message_id) DO UPDATE SET meta = excluded.meta;
+            """, (chat_id, message_id, json.dumps(meta, ensure_ascii=False), now))
+            if purge_ttl:
+                self.conn.execute("DELETE FROM mod_cards WHERE created_at < ?;", (now - purge_ttl,))
+        await self.transaction(save)
+
+    async def load_mod_card(self, chat_id: int, message_id: int, ttl: float):
+        now = time.time()
+        row = await self.fetchrow("""
+            SELECT meta, created_at FROM mod_cards WHERE chat_id = ? AND message_id = ? AND created_at >= ?;
+        """, chat_id, message_id, now - ttl)
+        return (json.loads(row["meta"]), now - row["created_at"]) if row else None
+
+    async def delete_mod_card(self, chat_id: int, message_id: int):
+        await self.execute("DELETE FROM mod_cards WHERE chat_id = ? AND message_id = ?;", chat_id, message_id)
+
+    async def seen_posts(self):
+        query = "SELECT source, CAST(post_id AS TEXT) AS post_id FROM seen_posts ORDER BY seen_at;"
+        async for row in self.cursor(query):
+            yield row
+
+    async def seen_hashes(self):
+        query = """
+            SELECT source, CAST(post_id AS TEXT) AS post_id, lower(hex(md5)) AS file_md5, phash
+            FROM seen_hashes ORDER BY created_at;
+        """
+        async for row in self.cursor(query):
+            yield row
+
+    async def save_phashes(self, source: str, rows: list):
+        def save():
+            self.conn.executemany("""
+                INSERT INTO seen_hashes (source, post_id, phash, created_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT (source, post_id) DO UPDATE SET phash = excluded.phash;
+            """, [(source, int(post_id), phash, time.time()) for post_id, phash in rows])
+        await self.transaction(save)
+
+    async def classify_posts(self, source: str, unknown: list) -> dict:
+        """Виден ли каждый пост из [(post_id, md5)] и первый пост с тем же md5."""
+        def classify():
+            rows = {}
+            for post_id, file_md5 in unknown:
+                seen = self.conn.execute(
+                    "SELECT 1 FROM seen_posts WHERE source = ? AND post_id = ?;", (source, int(post_id))
+                ).fetchone() is not None
+                dup = self.conn.execute(
+                    "SELECT source, post_id FROM seen_hashes WHERE md5 = ? LIMIT 1;", (bytes.fromhex(file_md5),)
+                ).fetchone() if file_md5 else None
+                rows[post_id] = {"seen": seen, "dup_source": dup and dup[0], "dup_post_id": dup and str(dup[1])}
+            return rows
+        return await self.run(classify)
+
+    async def insert_seen_posts(self, source: str, fresh: list) -> set:
+        """Записывает [(пост, post_id, md5, дубликат)] одной транзакцией; возвращает реально вставленные post_id."""
+        def insert():
+            now, claimed = time.time(), set()
+            for _, post_id, file_md5, _ in fresh:
+                cur = self.conn.execute(
+                    "INSERT OR IGNORE INTO seen_posts (source, post_id, seen_at) VALUES (?, ?, ?);", (source, int(post_id), now)
+                )
+                if not cur.rowcount: continue
+                claimed.add(post_id)
+                if file_md5:
+                    self.conn.execute(
+                        "INSERT OR IGNORE INTO seen_hashes (source, post_id, md5, created_at) VALUES (?, ?, ?, ?);",
+                        (source, int(post_id), bytes.fromhex(file_md5), now)
+                    )
+            return claimed
+        return await self.transaction(insert)
+
+    async def maintain_seen_posts(self):
+        """Без партиций: посты старше SEEN_RETENTION_DAYS удаляются запросом, хеши остаются."""
+        def purge():
+            cutoff = time.time() - SEEN_RETENTION_DAYS * 86400
+            deleted = self.conn.execute("DELETE FROM seen_posts WHERE seen_at < ?;", (cutoff,)).rowcount
+            self.conn.execute("""
+                DELETE FROM media_file_ids WHERE created_at < ?
+                  AND NOT EXISTS (SELECT 1 FROM publish_queue q WHERE q.post_key = media_file_ids.post_key);
+            """, (cutoff,))
+            return deleted
+        deleted = await self.transaction(purge)
+        if deleted: logger.info(f"🧹 Удалено {deleted} постов старше {SEEN_RETENTION_DAYS} дн.")
+
+async def init_db() -> bool:
+    """Открывает хранилище и готовит схему; False, если оно не готово и парсер запускать нельзя.
+
+    С DATABASE_URL это PostgreSQL, без него — встроенная SQLite в SQLITE_PATH.
+    """
+    global storage
+    backend = PostgresStorage(database_dsn()) if DATABASE_URL else SqliteStorage(SQLITE_PATH)
+    try:
+        await backend.connect()
+    except Exception as e:
+        logger.error(f"❌ Ошибка подключения к {backend.name}: {e}. База данных отключена.")
+        return False
+    # Даже при ошибке схемы очередью и карточками можно пользоваться, не работает только парсер
+    storage = backend
+    try:
+        await backend.init_schema()
+        logger.info(f"✅ База данных {backend.name} успешно инициализирована!")
+        return True
     except Exception as e:
-        logger.error(f"❌ Ошибка инициализации PostgreSQL: {e}")
+        logger.error(f"❌ Ошибка инициализации {backend.name}: {e}")
+    return False
 
+async def maintain_seen_posts():
+    if not storage: return
+    try:
+        await storage.maintain_seen_posts()
+    except Exception as e:
+        logger.error(f"❌ Ошибка обслуживания seen_posts: {e}")
+
+async def seen_maintenance_loop():
+    while True:
+        await maintain_seen_posts()
+        await asyncio.sleep(SEEN_MAINTENANCE_INTERVAL)
+
+@db_timed
 async def load_state():
     global MODERATION_CHAT_ID, LABELS
-    if not db_pool: return
+    if not storage: return
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT mod_chat_id, labels FROM parser_config WHERE id = 1;")
-            if row:
-                MODERATION_CHAT_ID = row["mod_chat_id"]
-                lbls = row["labels"]
-                LABELS = json.loads(lbls) if isinstance(lbls, str) else (lbls or [])
+        state = await storage.load_state()
+        if state:
+            MODERATION_CHAT_ID, LABELS = state
         logger.info(f"✅ Состояние загружено. Группа: {MODERATION_CHAT_ID}, Лейблов: {len(LABELS)}")
     except Exception as e:
         logger.error(f"❌ Ошибка загрузки состояния: {e}")
 
+@db_timed
 async def save_state():
-    if not db_pool: return
+    if not storage: return
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO parser_config (id, mod_chat_id, labels, updated_at)
-                VALUES (1, $1, $2::jsonb, CURRENT_TIMESTAMP)
-                ON CONFLICT (id) DO UPDATE 
-                SET mod_chat_id = EXCLUDED.mod_chat_id, labels = EXCLUDED.labels, updated_at = CURRENT_TIMESTAMP;
-            """, MODERATION_CHAT_ID, json.dumps(LABELS, ensure_ascii=False))
+        await storage.save_state(MODERATION_CHAT_ID, LABELS)
     except Exception as e:
         logger.error(f"❌ Ошибка сохранения состояния: {e}")
 
-async def load_queue_db():
-    if not db_pool: return []
+def feed_key(tags: str) -> str:
+    return " ".join(tags.split())
+
+@db_timed
+async def load_cursors(keys: list = None):
+    """Загружает курсоры и расписание всех лент или только keys (ленты, доставшиеся от другого экземпляра)."""
+    if not storage: return
+    try:
+        for r in await storage.load_cursors(keys):
+            key = (r["source"], r["tags"])
+            PARSER_CURSORS[key] = r["last_post_id"]
+            if r["poll_interval"]:
+                poll_scheduler.restore(key, r["poll_interval"], r["next_poll_at"], r["post_rate"])
+    except Exception as e:
+        logger.error(f"❌ Ошибка загрузки курсоров парсера: {e}")
+
+@db_timed
+async def advance_cursor(source: str, tags: str, last_post_id: int):
+    key = (source, feed_key(tags))
+    PARSER_CURSORS[key] = max(PARSER_CURSORS.get(key, 0), last_post_id)
+    if not storage: return
+    try:
+        await storage.advance_cursor(*key, last_post_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения курсора {source}: {e}")
+
+@db_timed
+async def save_poll_state(key: tuple, state: dict):
+    if not storage: return
+    try:
+        await storage.save_poll_state(key, state)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения расписания {key[0]}: {e}")
+
+def media_post_key(source: str, post_id) -> str:
+    return f"{source}:{post_id}"
+
+@db_timed
+async def enqueue_post(file_id: str, caption: str = None, media_type: str = "photo", file_url: str = None, post_key: str = None):
+    """Кладёт пост в очередь; если Telegram уже отдавал file_id для post_key, берётся он."""
+    if not storage: return None
+    try:
+        return await storage.enqueue_post(file_id, caption, media_type, file_url, post_key)
+    except Exception as e:
+        logger.error(f"❌ Ошибка добавления в очередь: {e}")
+    return None
+
+@db_timed
+async def save_file_id(post_key: str, file_id: str):
+    """Запоминает file_id поста и подменяет им ссылку у уже стоящих в очереди копий."""
+    if not storage or not post_key: return
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT queue FROM parser_config WHERE id = 1;")
-            if row and row["queue"]:
-                q = row["queue"]
-                return json.loads(q) if isinstance(q, str) else q
+        await storage.save_file_id(post_key, file_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения file_id {post_key}: {e}")
+
+@db_timed
+async def dequeue_post(item_id: int = None):
+    """Атомарно забирает из очереди конкретный элемент или, без item_id, самый старый."""
+    if not storage: return None
+    try:
+        return await storage.dequeue_post(item_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка извлечения из очереди: {e}")
+    return None
+
+@db_timed
+async def get_queue_page(after_id: int = 0, limit: int = 5) -> list:
+    if not storage: return []
+    try:
+        return await storage.get_queue_page(after_id, limit)
     except Exception as e:
         logger.error(f"❌ Ошибка чтения очереди: {e}")
     return []
 
-async def save_queue_db(queue_data):
-    if not db_pool: return
+@db_timed
+async def get_queue_size() -> int:
+    if not storage: return 0
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO parser_config (id, queue, updated_at)
-                VALUES (1, $1::jsonb, CURRENT_TIMESTAMP)
-                ON CONFLICT (id) DO UPDATE SET queue = EXCLUDED.queue, updated_at = CURRENT_TIMESTAMP;
-            """, json.dumps(queue_data, ensure_ascii=False))
+        return await storage.get_queue_size()
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения очереди: {e}")
+        logger.error(f"❌ Ошибка чтения очереди: {e}")
+    return 0
 
-async def is_post_seen(source: str, post_id: str) -> bool:
-    if not db_pool: return False
+@db_timed
+async def save_mod_card(chat_id: int, message_id: int, meta: dict, purge_ttl: float = None):
+    if not storage: return
     try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow("SELECT 1 FROM seen_posts WHERE source=$1 AND post_id=$2", source, str(post_id))
-            return row is not None
-    except Exception: return False
+        await storage.save_mod_card(chat_id, message_id, meta, purge_ttl)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения карточки модерации: {e}")
 
-async def is_md5_seen(file_md5: str):
-    if not db_pool or not file_md5: return None
+@db_timed
+async def load_mod_card(chat_id: int, message_id: int, ttl: float):
+    """(метаданные, возраст в секундах) карточки не старше ttl или None."""
+    if not storage: return None
     try:
-        async with db_pool.acquire() as conn:
-            return await conn.fetchrow("SELECT source, post_id FROM seen_posts WHERE file_md5=$1", str(file_md5))
-    except Exception: return None
+        return await storage.load_mod_card(chat_id, message_id, ttl)
+    except Exception as e:
+        logger.error(f"❌ Ошибка чтения карточки модерации: {e}")
+    return None
 
-async def mark_post_seen(source: str, post_id: str, file_md5: str = None):
-    if not db_pool: return
+@db_timed
+async def delete_mod_card(chat_id: int, message_id: int):
+    if not storage: return
     try:
-        async with db_pool.acquire() as conn:
-            await conn.execute("""
-                INSERT INTO seen_posts (source, post_id, file_md5)
-                VALUES ($1, $2, $3) ON CONFLICT DO NOTHING;
-            """, source, str(post_id), file_md5)
-    except Exception: pass
+        await storage.delete_mod_card(chat_id, message_id)
+    except Exception as e:
+        logger.error(f"❌ Ошибка удаления карточки модерации: {e}")
+
+@db_timed
+async def heartbeat_instance():
+    """Отмечает этот экземпляр живым; возвращает отсортированные id живых экземпляров или None при ошибке."""
+    if not storage or not storage.shared: return [INSTANCE_ID]
+    try:
+        return await storage.heartbeat_instance()
+    except Exception as e:
+        logger.error(f"❌ Ошибка пульса экземпляра: {e}")
+    return None
+
+@db_timed
+async def sync_feed_leases(feeds: list):
+    """Продлевает или захватывает аренду лент feeds и отпускает остальные свои.
+
+    Чужую аренду можно забрать только после её истечения. Возвращает множество
+    лент, которыми экземпляр владеет, или None при ошибке.
+    """
+    if not storage or not storage.shared: return set(feeds)
+    try:
+        return await storage.sync_feed_leases(feeds)
+    except Exception as e:
+        logger.error(f"❌ Ошибка аренды лент: {e}")
+    return None
+
+@db_timed
+async def release_instance():
+    """Отпускает аренду и снимает пульс, чтобы ленты сразу достались остальным."""
+    if not storage or not storage.shared: return
+    try:
+        await storage.release_instance()
+    except Exception as e:
+        logger.error(f"❌ Ошибка освобождения аренды: {e}")
+
+# --- ФИЛЬТР ВИДЕННЫХ ПОСТОВ ---
+
+class BloomFilter:
+    """Классический Bloom-фильтр на bytearray с двойным хешированием blake2b."""
+
+    def __init__(self, capacity: int, error_rate: float):
+        self.size = max(64, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _positions(self, key: str):
+        digest = hashlib.blake2b(key.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str):
+        for pos in self._positions(key):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(key))
+
+class SeenFilter:
+    """Bloom-фильтр всех виденных ключей + точный LRU недавних.
+
+    check() возвращает значение из LRU (точно видели), False (Bloom: точно
+    не видели) или None (нужно спросить базу). Пока фильтр не прогрет из
+    seen_posts, он всегда отвечает None. Если рядом работают другие экземпляры
+    (shared), их вставки в фильтр не попадают, и «точно нет» он не отвечает.
+    """
+
+    def __init__(self, capacity: int, lru_size: int):
+        self.capacity = capacity
+        self.bloom = BloomFilter(capacity, SEEN_FILTER_ERROR)
+        self.recent = OrderedDict()
+        self.lru_size = lru_size
+        self.ready = False
+        self.shared = False
+        self.stats = {"lru_hits": 0, "bloom_negatives": 0, "db_lookups": 0}
+
+    @staticmethod
+    def post_key(source: str, post_id: str) -> str:
+        return f"p:{source}:{post_id}"
+
+    @staticmethod
+    def md5_key(file_md5: str) -> str:
+        return f"m:{file_md5}"
+
+    def add(self, key: str, value=True):
+        if key not in self.recent:
+            self.bloom.add(key)
+        self.recent[key] = value
+        self.recent.move_to_end(key)
+        if len(self.recent) > self.lru_size:
+            self.recent.popitem(last=False)
+
+    def _count(self, result: str):
+        self.stats[result] += 1
+        SEEN_CHECKS.labels(result).inc()
+
+    def check(self, key: str):
+        if self.ready:
+            if key in self.recent:
+                self.recent.move_to_end(key)
+                self._count("lru_hits")
+                return self.recent[key]
+            if not self.shared and key not in self.bloom:
+                self._count("bloom_negatives")
+                return False
+        self._count("db_lookups")
+        return None
+
+    def describe(self) -> str:
+        total = sum(self.stats.values()) or 1
+        fill = int.from_bytes(self.bloom.bits, "little").bit_count() / self.bloom.size
+        return (
+            f"Ключей в Bloom: {self.bloom.count} / {self.capacity} (заполнено {fill:.1%})\n"
+            f"LRU: {len(self.recent)} / {self.lru_size}\n"
+            f"Попаданий LRU: {self.stats['lru_hits']}, точных промахов Bloom: {self.stats['bloom_negatives']}, "
+            f"запросов в базу: {self.stats['db_lookups']} ({self.stats['db_lookups'] / total:.1%})"
+        )
+
+seen_filter = SeenFilter(SEEN_FILTER_CAPACITY, SEEN_LRU_SIZE)
+
+@db_timed
+async def warm_seen_filter():
+    """Заполняет фильтр постами из seen_posts, а md5 и индекс перцептивных хешей — из seen_hashes.
+
+    До успешного прогрева фильтр не отвечает «точно нет».
+    """
+    if not storage: return
+    try:
+        async for row in storage.seen_posts():
+            seen_filter.add(SeenFilter.post_key(row["source"], row["post_id"]))
+        async for row in storage.seen_hashes():
+            md5_key = SeenFilter.md5_key(row["file_md5"]) if row["file_md5"] else None
+            if md5_key and md5_key not in seen_filter.recent:
+                seen_filter.add(md5_key, {"source": row["source"], "post_id": row["post_id"]})
+            if row["phash"] is not None:
+                phash_index.add(row["phash"] & PHASH_MASK, (row["source"], row["post_id"]))
+        seen_filter.ready = True
+        if seen_filter.bloom.count > SEEN_FILTER_CAPACITY:
+            logger.warning(f"⚠️ В seen_posts больше ключей, чем SEEN_FILTER_CAPACITY ({SEEN_FILTER_CAPACITY}): фильтр будет чаще ходить в базу.")
+        logger.info(f"✅ Фильтр виденных постов прогрет: {seen_filter.bloom.count} ключей.")
+    except Exception as e:
+        logger.error(f"❌ Ошибка прогрева фильтра виденных постов: {e}")
+
+def normalize_md5(value):
+    """md5 в нижнем регистре или None, если это не 32 hex-символа."""
+    if not value or len(value) != 32: return None
+    try:
+        bytes.fromhex(value)
+    except ValueError:
+        return None
+    return value.lower()
+
+@db_timed
+async def claim_new_posts(source: str, posts: list) -> list:
+    """Пакетная дедупликация страницы: один запрос на классификацию и одна пакетная вставка.
+
+    Возвращает [(пост, дубликат)] только для новых постов, где дубликат —
+    {"source", "post_id"} уже виденного поста с тем же md5 или None.
+    None — база недоступна, страницу нужно выбрать заново.
+    В базу уходят только посты, про которые не смог ответить seen_filter.
+    """
+    if not posts: return []
+    if not storage: return [(p, None) for p in posts]
+
+    ids = [str(p.get("id")) for p in posts]
+    md5s = [normalize_md5(p.get("md5") or p.get("hash")) for p in posts]
+
+    verdicts, unknown = {}, []  # post_id -> дубликат для точно новых; посты, которые надо проверить в базе
+    for post_id, file_md5 in zip(ids, md5s):
+        seen = seen_filter.check(SeenFilter.post_key(source, post_id))
+        if seen: continue
+        dup = seen_filter.check(SeenFilter.md5_key(file_md5)) if file_md5 else False
+        if seen is None or dup is None:
+            unknown.append((post_id, file_md5))
+        else:
+            verdicts[post_id] = dup or None
+
+    try:
+        rows = await storage.classify_posts(source, unknown) if unknown else {}
+
+        fresh, page_md5 = [], {}
+        for post, post_id, file_md5 in zip(posts, ids, md5s):
+            if post_id in rows:
+                row = rows[post_id]
+                if row["seen"]:
+                    seen_filter.add(SeenFilter.post_key(source, post_id))
+                    continue
+                duplicate_info = {"source": row["dup_source"], "post_id": row["dup_post_id"]} if row["dup_source"] else None
+            elif post_id in verdicts:
+                duplicate_info = verdicts[post_id]
+            else: continue
+            if duplicate_info and (duplicate_info["source"], duplicate_info["post_id"]) == (source, post_id):
+                continue  # партиция с постом удалена, а хеш в seen_hashes остался: это тот же пост
+            if not duplicate_info and file_md5 in page_md5:
+                duplicate_info = {"source": source, "post_id": page_md5[file_md5]}
+            if file_md5: page_md5.setdefault(file_md5, post_id)
+            fresh.append((post, post_id, file_md5, duplicate_info))
+        if not fresh:
+            DEDUP_POSTS.labels("seen").inc(len(posts))
+            return []
+
+        claimed = await storage.insert_seen_posts(source, fresh)
+        for _, post_id, file_md5, dup in fresh:
+            seen_filter.add(SeenFilter.post_key(source, post_id))
+            if file_md5:
+                seen_filter.add(SeenFilter.md5_key(file_md5), dup or {"source": source, "post_id": post_id})
+        result = [(post, dup) for post, post_id, _, dup in fresh if post_id in claimed]
+        DEDUP_POSTS.labels("seen").inc(len(posts) - len(result))
+        DEDUP_POSTS.labels("md5_duplicate").inc(sum(1 for _, dup in result if dup))
+        DEDUP_POSTS.labels("new").inc(sum(1 for _, dup in result if not dup))
+        return result
+    except Exception as e:
+        logger.error(f"❌ Ошибка дедупликации {source}: {e}")
+        return None
+
+# --- ПОХОЖИЕ АРТЫ (ПЕРЦЕПТИВНЫЙ ХЕШ) ---
+
+PHASH_MASK = (1 << 64) - 1
+hash_pool = ThreadPoolExecutor(max_workers=PHASH_WORKERS, thread_name_prefix="phash")
+
+class RecentHashIndex:
+    """Последние max_size хешей с поиском соседей по расстоянию Хэмминга (multi-index hashing).
+
+    64 бита режутся на max_dist + 1 блоков: у хешей на расстоянии не больше
+    max_dist хотя бы один блок совпадает целиком (принцип Дирихле). Поэтому
+    кандидатов достаточно собрать по точному совпадению блоков в словарях и
+    досчитать расстояние только для них. Самые старые хеши вытесняются по одному.
+    """
+
+    def __init__(self, max_size: int, max_dist: int):
+        self.max_size = max(1, max_size)
+        self.max_dist = max_dist
+        count = max_dist + 1
+        widths = [64 // count + (i < 64 % count) for i in range(count)]
+        self.blocks = []  # [(сдвиг, маска)]
+        shift = 0
+        for width in widths:
+            self.blocks.append((shift, (1 << width) - 1))
+            shift += width
+        self.tables = [{} for _ in self.blocks]  # блок -> {хеш: None}
+        self.entries = {}  # хеш -> значение, в порядке добавления
+
+    @property
+    def size(self) -> int:
+        return len(self.entries)
+
+    def add(self, h: int, value):
+        if h in self.entries: return
+        if len(self.entries) >= self.max_size:
+            self.discard(next(iter(self.entries)))
+        self.entries[h] = value
+        for (shift, mask), table in zip(self.blocks, self.tables):
+            table.setdefault((h >> shift) & mask, {})[h] = None
+
+    def discard(self, h: int):
+        self.entries.pop(h, None)
+        for (shift, mask), table in zip(self.blocks, self.tables):
+            key = (h >> shift) & mask
+            bucket = table.get(key)
+            if bucket is None: continue
+            bucket.pop(h, None)
+            if not bucket:
+                del table[key]
+
+    def find(self, h: int):
+        """Ближайший хеш не дальше max_dist: (расстояние, значение) или None."""
+        best = None
+        checked = set()
+        for (shift, mask), table in zip(self.blocks, self.tables):
+            for other in table.get((h >> shift) & mask, ()):
+                if other in checked: continue
+                checked.add(other)
+                dist = (h ^ other).bit_count()
+                if dist <= self.max_dist and (best is None or dist < best[0]):
+                    best = (dist, self.entries[other])
+        return best
+
+phash_index = RecentHashIndex(PHASH_INDEX_SIZE, PHASH_MAX_DISTANCE)
+
+def compute_dhash(data: bytes) -> int:
+    """dHash 8x8: сравнение соседних пикселей уменьшенного серого превью."""
+    with Image.open(BytesIO(data)) as img:
+        img.draft("L", (64, 64))
+        pixels = list(img.convert("L").resize((9, 8), Image.LANCZOS).getdata())
+    h = 0
+    for row in range(8):
+        for col in range(8):
+            h = (h << 1) | (pixels[row * 9 + col] > pixels[row * 9 + col + 1])
+    return h
+
+async def preview_hash(post: dict):
+    url = post.get("preview_url") or post.get("sample_url")
+    if not url: return None
+    try:
+        async with http_session.get(url) as resp:
+            if resp.status != 200: return None
+            data = await resp.read()
+        return await asyncio.get_running_loop().run_in_executor(hash_pool, compute_dhash, data)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось посчитать хеш превью {url}: {e}")
+        return None
+
+async def find_near_duplicates(source: str, fresh: list) -> list:
+    """Дополняет [(пост, дубликат)] похожими по pHash артами и сохраняет хеши новых постов."""
+    if not PHASH_ENABLED or not fresh: return fresh
+    hashes = await asyncio.gather(*(preview_hash(post) for post, _ in fresh))
+
+    result, rows = [], []
+    for (post, duplicate_info), h in zip(fresh, hashes):
+        post_id = str(post.get("id"))
+        if h is not None:
+            if not duplicate_info:
+                match = phash_index.find(h)
+                if match:
+                    DEDUP_POSTS.labels("phash_duplicate").inc()
+                    duplicate_info = {"source": match[1][0], "post_id": match[1][1], "distance": match[0]}
+            phash_index.add(h, (source, post_id))
+            rows.append((post_id, h - (1 << 64) if h >= 1 << 63 else h))
+        result.append((post, duplicate_info))
+
+    if rows:
+        await save_phashes(source, rows)
+    return result
+
+@db_timed
+async def save_phashes(source: str, rows: list):
+    if not storage: return
+    try:
+        await storage.save_phashes(source, rows)
+    except Exception as e:
+        logger.error(f"❌ Ошибка сохранения перцептивных хешей: {e}")
+
+# --- МЕТАДАННЫЕ КАРТОЧЕК МОДЕРАЦИИ ---
+
+class ModerationStore:
+    """Метаданные карточек модерации: LRU с TTL в памяти поверх таблицы mod_cards.
+
+    Память ограничена size записями, в базе записи живут ttl секунд и
+    переживают перезапуск. Повторное чтение недавней карточки обходится без базы.
+    """
+
+    PURGE_EVERY = 100
+
+    def __init__(self, size: int, ttl: float):
+        self.size = size
+        self.ttl = ttl
+        self.cache = OrderedDict()
+        self.puts = 0
+
+    def _remember(self, key: tuple, meta: dict, created: float):
+        self.cache[key] = (created, meta)
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.size:
+            self.cache.popitem(last=False)
+
+    async def put(self, chat_id: int, message_id: int, meta: dict):
+        self._remember((chat_id, message_id), meta, time.time())
+        self.puts += 1
+        await save_mod_card(chat_id, message_id, meta, purge_ttl=self.ttl if self.puts % self.PURGE_EVERY == 0 else None)
+
+    async def get(self, chat_id: int, message_id: int):
+        key = (chat_id, message_id)
+        cached = self.cache.get(key)
+        if cached and time.time() - cached[0] < self.ttl:
+            self.cache.move_to_end(key)
+            return cached[1]
+        self.cache.pop(key, None)
+        found = await load_mod_card(chat_id, message_id, self.ttl)
+        if not found: return None
+        meta, age = found
+        self._remember(key, meta, time.time() - age)
+        return meta
+
+    async def discard(self, chat_id: int, message_id: int):
+        self.cache.pop((chat_id, message_id), None)
+        await delete_mod_card(chat_id, message_id)
+
+mod_store = ModerationStore(MOD_STORE_SIZE, MOD_STORE_TTL_DAYS * 86400)
+
+# --- HTTP-КЛИЕНТ И ЛИМИТЫ ---
+
+class TokenBucket:
+    """Токен-бакет: rate токенов в секунду, не больше burst подряд."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self.lock = asyncio.Lock()
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до следующего свободного токена."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        wait = max(0.0, self.blocked_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        self.tokens -= 1
+
+    def block(self, seconds: float):
+        """Полная пауза (например, по Retry-After)."""
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self):
+        async with self.lock:
+            while (wait := self.delay()) > 0:
+                await asyncio.sleep(wait)
+            self.consume()
+
+def get_host_limiter(url: str) -> TokenBucket:
+    host = urlsplit(url).hostname or url
+    if host not in host_limiters:
+        host_limiters[host] = TokenBucket(BOORU_RPS, BOORU_BURST)
+    return host_limiters[host]
+
+def parse_retry_after(value, default: float = 3.0) -> float:
+    """Retry-After бывает в секундах или HTTP-датой."""
+    if not value: return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+async def init_http():
+    global http_session
+    connector = aiohttp.TCPConnector(limit=20, limit_per_host=4, ttl_dns_cache=300, keepalive_timeout=60)
+    http_session = aiohttp.ClientSession(
+        connector=connector,
+        timeout=aiohttp.ClientTimeout(total=10),
+        headers={
+            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
+            "Accept": "application/json, text/plain, */*"
+        }
+    )
+
+async def close_http():
+    if http_session and not http_session.closed:
+        await http_session.close()
+
+# --- ИСХОДЯЩИЕ СООБЩЕНИЯ TELEGRAM ---
+
+class SendScheduler:
+    """Единая очередь исходящих запросов к Telegram.
+
+    Задачи идут по приоритету (ответы пользователю раньше карточек модерации),
+    с токен-бакетом на каждый чат и общим на бота. Чат, упёршийся в лимит, не
+    держит остальные: его задача откладывается, а очередь идёт дальше.
+    При TelegramRetryAfter чат ставится на паузу, и запрос повторяется.
+    """
+
+    def __init__(self):
+        self.queue = asyncio.PriorityQueue()
+        self.global_bucket = TokenBucket(TG_GLOBAL_RPS, TG_GLOBAL_RPS)
+        self.chat_buckets = {}
+        self.seq = itertools.count()
+        self.task = None
+
+    def bucket_for(self, chat_id: int) -> TokenBucket:
+        if chat_id not in self.chat_buckets:
+            # Положительные id — личные чаты, отрицательные — группы и каналы
+            if chat_id > 0:
+                self.chat_buckets[chat_id] = TokenBucket(TG_PRIVATE_RPS, 1)
+            else:
+                self.chat_buckets[chat_id] = TokenBucket(TG_GROUP_RPS, TG_GROUP_BURST)
+        return self.chat_buckets[chat_id]
+
+    def start(self):
+        if not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def submit(self, chat_id: int, func, /, *args, priority: int = PRIORITY_BULK, **kwargs):
+        """Ставит вызов func(*args, **kwargs) в очередь и ждёт его результата."""
+        self.start()
+        future = asyncio.get_running_loop().create_future()
+        self.queue.put_nowait((priority, next(self.seq), chat_id, func, args, kwargs, future, 0))
+        return await future
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            job = await self.queue.get()
+            chat_bucket = self.bucket_for(job[2])
+            wait = max(chat_bucket.delay(), self.global_bucket.delay())
+            if wait > 0:
+                loop.call_later(wait, self.queue.put_nowait, job)
+                continue
+            chat_bucket.consume()
+            self.global_bucket.consume()
+            asyncio.create_task(self.execute(job))
+
+    async def execute(self, job):
+        priority, seq, chat_id, func, args, kwargs, future, attempt = job
+        if future.done(): return
+        method = getattr(func, "__name__", "call")
+        try:
+            with TG_SECONDS.labels(method).time():
+                result = await func(*args, **kwargs)
+        except TelegramRetryAfter as e:
+            TG_RETRY_AFTER.labels(method).inc()
+            self.bucket_for(chat_id).block(e.retry_after)
+            if attempt < TG_MAX_RETRIES:
+                logger.warning(f"⚠️ Telegram: флуд-лимит в чате {chat_id}, повтор через {e.retry_after} сек.")
+                self.queue.put_nowait((priority, seq, chat_id, func, args, kwargs, future, attempt + 1))
+            elif not future.done():
+                future.set_exception(e)
+        except Exception as e:
+            if not future.done(): future.set_exception(e)
+        else:
+            if not future.done(): future.set_result(result)
+
+outbox = SendScheduler()
+
+async def reply(message: Message, text: str, **kwargs):
+    return await outbox.submit(message.chat.id, message.reply, text, priority=PRIORITY_INTERACTIVE, **kwargs)
+
+# --- ЛОКАЛЬНЫЙ КЭШ МЕДИА ---
+
+def media_key(url: str, md5: str = None) -> str:
+    """Ключ кэша — md5 файла: из поста, из имени файла в ссылке (так их называют буры) или хеш самой ссылки."""
+    stem = os.path.splitext(os.path.basename(urlsplit(url).path))[0]
+    return normalize_md5(md5) or normalize_md5(stem) or hashlib.md5(url.encode()).hexdigest()
+
+def downscale_image(path: str) -> int:
+    """Ужимает картинку до MEDIA_MAX_SIDE по большей стороне и сохраняет JPEG; возвращает размер файла."""
+    size = os.path.getsize(path)
+    try:
+        with Image.open(path) as img:
+            if max(img.size) <= MEDIA_MAX_SIDE and size <= TG_PHOTO_MAX_BYTES: return size
+            img.draft("RGB", (MEDIA_MAX_SIDE, MEDIA_MAX_SIDE))
+            small = img.convert("RGB")
+        small.thumbnail((MEDIA_MAX_SIDE, MEDIA_MAX_SIDE), Image.LANCZOS)
+        small.save(path + ".tmp", "JPEG", quality=90)
+    except Exception as e:
+        logger.warning(f"⚠️ Не удалось ужать {path}: {e}")
+        return size
+    os.replace(path + ".tmp", path)
+    return os.path.getsize(path)
+
+class MediaCache:
+    """Файлы с бур на диске, по ключу md5, с LRU-вытеснением по суммарному размеру.
+
+    Скачивание идёт потоком кусками по MEDIA_CHUNK_SIZE во временный файл,
+    одновременные запросы одного файла ждут одну загрузку. Порядок LRU
+    хранится в mtime файлов и переживает перезапуск.
+    """
+
+    def __init__(self, directory: str, max_bytes: int):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.index = OrderedDict()  # ключ -> размер, от давно не нужных к свежим
+        self.total = 0
+        self.locks = {}
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def load(self):
+        """Восстанавливает индекс с диска; недокачанные .tmp удаляет."""
+        os.makedirs(self.directory, exist_ok=True)
+        files = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                if name.endswith(".tmp"):
+                    os.remove(path)
+                    continue
+                st = os.stat(path)
+                files.append((st.st_mtime, name, st.st_size))
+        for _, key, size in sorted(files):
+            self.index[key] = size
+            self.total += size
+        self._evict()
+        logger.info(f"✅ Кэш медиа: {len(self.index)} файлов, {self.total / 2 ** 20:.0f} МБ")
+
+    def _evict(self):
+        while self.total > self.max_bytes and len(self.index) > 1:
+            key, size = self.index.popitem(last=False)
+            self.total -= size
+            try: os.remove(self.path(key))
+            except OSError: pass
+
+    async def fetch(self, url: str, md5: str = None):
+        """Путь к файлу в кэше; при промахе скачивает. None, если скачать не удалось."""
+        key = media_key(url, md5)
+        if key in self.index:
+            MEDIA_CACHE_REQUESTS.labels("hit").inc()
+            self.index.move_to_end(key)
+            try: os.utime(self.path(key))
+            except OSError: pass
+            return self.path(key)
+
+        lock = self.locks.setdefault(key, asyncio.Lock())
+        async with lock:
+            if key in self.index: return self.path(key)
+            try:
+                size = await self._download(url, self.path(key))
+            except Exception as e:
+                MEDIA_CACHE_REQUESTS.labels("error").inc()
+                logger.warning(f"⚠️ Не удалось скачать {url} в кэш: {e}")
+                return None
+            finally:
+                self.locks.pop(key, None)
+            MEDIA_CACHE_REQUESTS.labels("miss").inc()
+            self.index[key] = size
+            self.total += size
+            self._evict()
+            return self.path(key)
+
+    async def _download(self, url: str, path: str) -> int:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp, size = path + ".tmp", 0
+        await get_host_limiter(url).acquire()
+        try:
+            async with http_session.get(url, timeout=aiohttp.ClientTimeout(total=MEDIA_DOWNLOAD_TIMEOUT)) as resp:
+                resp.raise_for_status()
+                async with aiofiles.open(tmp, "wb") as f:
+                    async for chunk in resp.content.iter_chunked(MEDIA_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > MEDIA_MAX_DOWNLOAD_MB * 2 ** 20:
+                            raise ValueError(f"файл больше {MEDIA_MAX_DOWNLOAD_MB} МБ")
+                        await f.write(chunk)
+        except BaseException:
+            try: os.remove(tmp)
+            except OSError: pass
+            raise
+        if MEDIA_DOWNSCALE:
+            size = await asyncio.get_running_loop().run_in_executor(hash_pool, downscale_image, tmp)
+        os.replace(tmp, path)
+        return size
+
+    async def read(self, url: str, md5: str = None):
+        for _ in range(2):
+            path = await self.fetch(url, md5)
+            if not path: return None
+            try:
+                async with aiofiles.open(path, "rb") as f:
+                    return await f.read()
+            except FileNotFoundError:
+                # Файл удалили мимо кэша — забываем его и качаем заново
+                self.total -= self.index.pop(media_key(url, md5), 0)
+        return None
+
+media_cache = MediaCache(MEDIA_CACHE_DIR, MEDIA_CACHE_MAX_MB * 2 ** 20)
+
+# Ошибки, при которых Telegram не смог сам забрать файл по ссылке; остальные (подпись, разметка,
+# чат) повторятся и при загрузке файлом. Слишком большую картинку исправит ужатие в кэше.
+URL_FETCH_ERRORS = (
+    "failed to get http url content",
+    "wrong type of the web page content",
+    "wrong file identifier/http url specified",
+    "photo_invalid_dimensions",
+)
+PHOTO_EXTENSIONS = {".jpg", ".jpeg", ".png", ".webp"}
+
+async def send_photo_with_fallback(chat_id: int, photo, file_url: str = None, md5: str = None,
+                                   priority: int = PRIORITY_BULK, **kwargs):
+    """send_photo через очередь; если Telegram не смог забрать ссылку, загружает файл из локального кэша."""
+    try:
+        return await outbox.submit(chat_id, bot.send_photo, chat_id=chat_id, photo=photo, priority=priority, **kwargs)
+    except TelegramBadRequest as e:
+        url = file_url or (photo if isinstance(photo, str) and photo.startswith("http") else None)
+        if not url or not any(err in e.message.lower() for err in URL_FETCH_ERRORS): raise
+        # Видео (webm, mp4) фотографией не загрузить
+        if os.path.splitext(urlsplit(url).path)[1].lower() not in PHOTO_EXTENSIONS: raise
+        logger.warning(f"⚠️ Telegram не принял ссылку {url} ({e.message}), загружаем файл сами.")
+        data = await media_cache.read(url, md5)
+        if data is None: raise
+        upload = BufferedInputFile(data, filename=f"{media_key(url, md5)}.jpg")
+        return await outbox.submit(chat_id, bot.send_photo, chat_id=chat_id, photo=upload, priority=priority, **kwargs)
 
 # --- МОДУЛЬ ПАРСИНГА ---
 
 async def fetch_booru_posts(source: str, tags: str, limit: int = 20):
     posts = []
-    headers = {
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36",
-        "Accept": "application/json, text/plain, */*"
-    }
     clean_tags = tags.strip().replace(" ", "+")
     params = {"page": "dapi", "s": "post", "q": "index", "json": "1", "tags": clean_tags, "limit": str(limit)}
 
     if source == "rule34":
-        base_url = "https://api.rule34.xxx/index.php"
+        base_url = R34_API_URL
         if R34_USER_ID and R34_API_KEY:
             params["user_id"], params["api_key"] = R34_USER_ID, R34_API_KEY
     elif source == "gelbooru":
-        base_url = "https://gelbooru.com/index.php"
+        base_url = GELBOORU_API_URL
         if GELBOORU_USER_ID and GELBOORU_API_KEY:
             params["user_id"], params["api_key"] = GELBOORU_USER_ID, GELBOORU_API_KEY
     else: return posts
 
-    try:
-        await asyncio.sleep(0.5)
-        async with aiohttp.ClientSession() as session:
-            async with session.get(base_url, params=params, headers=headers, timeout=10) as resp:
+    limiter = get_host_limiter(base_url)
+    for _ in range(BOORU_MAX_RETRIES + 1):
+        # Время пишется и для 429, ошибок HTTP и исключений — именно их гистограмма и должна показывать
+        started, result = None, "error"
+        try:
+            await limiter.acquire()
+            started = time.perf_counter()
+            async with http_session.get(base_url, params=params) as resp:
+                if resp.status == 429:
+                    result = "rate_limited"
+                    BOORU_429.labels(source).inc()
+                    delay = parse_retry_after(resp.headers.get("Retry-After"))
+                    limiter.block(delay)
+                    logger.warning(f"⚠️ {source} ответил 429 (Too Many Requests). Пауза {delay:.1f} сек.")
+                    continue
                 if resp.status == 200:
                     text_data = await resp.text()
                     if text_data.strip():
                         data = json.loads(text_data)
                         posts = data if isinstance(data, list) else data.get("post", [])
-                elif resp.status == 429:
-                    logger.warning(f"⚠️ {source} ответил 429 (Too Many Requests). Пауза 3 сек.")
-                    await asyncio.sleep(3)
-    except Exception as e:
-        logger.error(f"❌ Ошибка запроса {source} ({clean_tags}): {e}")
+                result = "ok" if resp.status == 200 else "http_error"
+        except Exception as e:
+            logger.error(f"❌ Ошибка запроса {source} ({clean_tags}): {e}")
+        finally:
+            if started is not None:
+                FETCH_SECONDS.labels(source, result).observe(time.perf_counter() - started)
+        break
 
     return posts
 
-async def process_parsed_post(label: dict, post_data: dict, source: str):
+async def process_parsed_page(page: list, source: str) -> bool:
+    """page — [(пост, подходящие лейблы)] одной выборки. False, если страницу не удалось дедуплицировать."""
+    labels_by_id = {str(post.get("id")): labels for post, labels in page}
+    posts = [post for post, _ in page if post.get("file_url") and post.get("id")]
+    fresh = await claim_new_posts(source, posts)
+    if fresh is None: return False
+    for post, duplicate_info in await find_near_duplicates(source, fresh):
+        await process_parsed_post(labels_by_id[str(post.get("id"))], post, source, duplicate_info)
+    return True
+
+async def process_parsed_post(labels: list, post_data: dict, source: str, duplicate_info: dict = None):
     post_id = str(post_data.get("id"))
     file_url = post_data.get("file_url")
-    file_md5 = post_data.get("md5") or post_data.get("hash")
-
-    if not file_url or not post_id: return
-    if await is_post_seen(source, post_id): return
-
-    duplicate_info = await is_md5_seen(file_md5)
-    await mark_post_seen(source, post_id, file_md5)
+    post_key = media_post_key(source, post_id)
+    # Пост может подойти нескольким лейблам: подпись и режим берём у первого AUTO, иначе у первого
+    label = next((l for l in labels if l.get("mode") == "AUTO"), labels[0])
 
     source_name = "🟡 Gelbooru" if source == "gelbooru" else "🟢 Rule34"
     source_link = f'<a href="https://{source}.xxx/index.php?page=post&s=view&id={post_id}">{source_name}</a>'
     
-    caption = f"🏷 <b>Лейбл:</b> {label.get('emoji', '🏷')} {label.get('name')}\n"
-    if duplicate_info:
+    label_names = ", ".join(f"{l.get('emoji', '🏷')} {l.get('name')}" for l in labels)
+    caption = f"🏷 <b>Лейбл:</b> {label_names}\n"
+    if duplicate_info and "distance" in duplicate_info:
+        caption = f"⚠️ <b>ПОХОЖИЙ АРТ</b> (уже выходил в {duplicate_info['source']}, #{duplicate_info['post_id']})\n" + caption
+    elif duplicate_info:
         caption = f"⚠️ <b>ВОЗМОЖНЫЙ ДУБЛИКАТ</b> (уже выходил в {duplicate_info['source']})\n" + caption
 
     caption += f"🔗 <b>Источник:</b> {source_link}\n🆔 <code>{post_id}</code>"
@@ -237,50 +1909,466 @@ async def process_parsed_post(label: dict, post_data: dict, source: str):
 
     mode = label.get("mode", "MANUAL")
     if mode == "AUTO" and not duplicate_info:
-        queue = await load_queue_db()
-        queue.append({"file_id": file_url, "type": "photo", "caption": custom_sig})
-        await save_queue_db(queue)
+        await enqueue_post(file_url, custom_sig, file_url=file_url, post_key=post_key)
         logger.info(f"⚡ [AUTO] Пост #{post_id} авто-добавлен в очередь!")
         return
 
     if MODERATION_CHAT_ID:
         try:
-            msg = await bot.send_photo(
-                chat_id=MODERATION_CHAT_ID,
-                photo=file_url,
+            msg = await send_photo_with_fallback(
+                MODERATION_CHAT_ID, file_url,
+                md5=post_data.get("md5") or post_data.get("hash"),
                 caption=caption,
                 reply_markup=kb
             )
-            post_metadata_store[f"mod_{msg.message_id}"] = {
+            # Дальше превью и публикации идут по file_id, без повторной загрузки с буры
+            if msg.photo:
+                await save_file_id(post_key, msg.photo[-1].file_id)
+            await mod_store.put(MODERATION_CHAT_ID, msg.message_id, {
                 "file_url": file_url,
                 "caption": custom_sig,
                 "source": source,
                 "post_id": post_id
-            }
+            })
         except Exception as e:
             logger.error(f"❌ Ошибка отправки карточки в группу: {e}")
 
+class PollScheduler:
+    """Куча (время следующего опроса, лента) с адаптивным интервалом для каждой ленты.
+
+    Лента — пара (источник, теги). Интервал подстраивается под наблюдаемую
+    частоту новых постов так, чтобы за опрос набегало около полстраницы;
+    пустые и неудачные опросы удваивают интервал до PARSER_MAX_INTERVAL.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.state = {}  # лента -> {"interval", "next_at", "rate", "last_at", "scheduled", "running"}
+
+    def _state(self, key: tuple) -> dict:
+        if key not in self.state:
+            self.state[key] = {
+                "interval": PARSER_SPEED, "next_at": time.time(), "rate": 0.0, "last_at": None,
+                "scheduled": False, "running": False
+            }
+        return self.state[key]
+
+    def _push(self, key: tuple):
+        st = self.state[key]
+        st["scheduled"] = True
+        heapq.heappush(self.heap, (st["next_at"], key))
+
+    def restore(self, key: tuple, interval: float, next_at: float, rate: float):
+        st = self._state(key)
+        st["interval"] = interval
+        st["next_at"] = next_at or time.time()
+        st["rate"] = rate or 0.0
+
+    def sync(self, keys):
+        """Ставит в расписание новые ленты и забывает удалённые."""
+        for key in keys:
+            st = self._state(key)
+            # Идущий опрос сам вернёт ленту в расписание через record()
+            if not st["scheduled"] and not st["running"]:
+                self._push(key)
+        for key in [k for k in self.state if k not in keys]:
+            del self.state[key]
+
+    def pop_due(self) -> list:
+        now, due = time.time(), []
+        while self.heap and self.heap[0][0] <= now:
+            _, key = heapq.heappop(self.heap)
+            st = self.state.get(key)
+            if st and st["scheduled"]:
+                st["scheduled"] = False
+                st["running"] = True
+                due.append(key)
+        return due
+
+    def next_delay(self) -> float:
+        return self.heap[0][0] - time.time() if self.heap else PARSER_SPEED
+
+    def record(self, key: tuple, new_posts: int) -> dict:
+        st = self._state(key)
+        now = time.time()
+        elapsed = now - st["last_at"] if st["last_at"] else st["interval"]
+        st["last_at"] = now
+        st["running"] = False
+        if new_posts:
+            st["rate"] = 0.5 * st["rate"] + 0.5 * new_posts / max(elapsed, 1)
+            st["interval"] = (PARSER_LIMIT / 2) / st["rate"]
+        else:
+            st["rate"] *= 0.5
+            st["interval"] *= 2
+        st["interval"] = min(max(st["interval"], PARSER_SPEED), PARSER_MAX_INTERVAL)
+        st["next_at"] = now + st["interval"]
+        self._push(key)
+        return st
+
+    def describe(self) -> str:
+        if not self.state: return "Лент в расписании нет."
+        intervals = [st["interval"] for st in self.state.values()]
+        return f"Лент: {len(self.state)}, интервал опроса от {min(intervals):.0f} до {max(intervals):.0f} сек."
+
+poll_scheduler = PollScheduler()
+parser_budget = TokenBucket(PARSER_BUDGET_PER_MIN / 60, PARSER_CONCURRENCY)
+
+def parse_tag_expr(tags: str):
+    """(обязательные теги, исключённые теги) или None, если выражение нельзя проверить локально.
+
+    Локально проверяем только простые теги и -отрицания; мета-теги (rating:,
+    score:, sort: ...), OR через ~ и маски * отдаём на сторону буры.
+    """
+    pos, neg = set(), set()
+    for tag in tags.lower().split():
+        if any(ch in tag for ch in ":~*()") or tag in ("-", "{", "}"):
+            return None
+        if tag.startswith("-"):
+            neg.add(tag[1:])
+        else:
+            pos.add(tag)
+    return (frozenset(pos), frozenset(neg)) if pos else None
+
+def expr_query(expr: tuple) -> str:
+    pos, neg = expr
+    return " ".join(sorted(pos) + sorted(f"-{t}" for t in neg))
+
+def coalesce_queries(items: list) -> list:
+    """Жадно покрывает лейблы [(лейбл, выражение)] минимумом запросов.
+
+    Кандидаты — выражения самих лейблов и общие части пар лейблов. Запрос
+    (P, N) покрывает лейбл (p, n), если P ⊆ p и N ⊆ n: всё, что нужно
+    лейблу, придёт в выдаче запроса, а лишнее отсеет LabelRouter.
+    """
+    candidates = {expr for _, expr in items}
+    for (_, (p1, n1)), (_, (p2, n2)) in itertools.combinations(items, 2):
+        if p1 & p2:
+            candidates.add((p1 & p2, n1 & n2))
+
+    plans, uncovered = [], list(items)
+    while uncovered:
+        def covered_by(c):
+            return [it for it in uncovered if c[0] <= it[1][0] and c[1] <= it[1][1]]
+        # Больше покрытых лейблов, при равенстве — более узкий запрос
+        best = max(candidates, key=lambda c: (len(covered_by(c)), len(c[0]) + len(c[1]), expr_query(c)))
+        covered = covered_by(best)
+        if len(covered) == 1 and covered[0][1] == best:
+            query = feed_key(covered[0][0]["tags"])
+        else:
+            query = expr_query(best)
+        plans.append((query, [label for label, _ in covered]))
+        uncovered = [it for it in uncovered if it not in covered]
+    return plans
+
+def labels_by_source(labels: list) -> dict:
+    """Источник -> лейблы с тегами, которые его опрашивают, в порядке LABELS."""
+    by_source = {}
+    for label in labels:
+        if not label.get("tags"): continue
+        for src in label.get("sources", ["rule34", "gelbooru"]):
+            by_source.setdefault(src, []).append(label)
+    return by_source
+
+def plan_feeds(labels: list) -> dict:
+    """Ленты (источник, теги запроса) -> лейблы, которые эта лента обслуживает."""
+    feeds = {}
+    for src, group in labels_by_source(labels).items():
+        local = []
+        for label in group:
+            expr = parse_tag_expr(label["tags"]) if PARSER_COALESCE else None
+            if expr:
+                local.append((label, expr))
+            else:
+                feeds.setdefault((src, feed_key(label["tags"])), []).append(label)
+        for query, covered in coalesce_queries(local):
+            feeds.setdefault((src, query), []).extend(covered)
+    return feeds
+
+class LabelRouter:
+    """Раскладывает посты ленты по всем лейблам источника, проверяя их теговые выражения локально.
+
+    Пост, выбранный лентой одного лейбла, достаётся и другим лейблам источника,
+    если подходит под их выражение: в другой ленте его уже отсеет дедупликация.
+    Инвертированный индекс ведёт от тега, которого нет в самом запросе, к
+    лейблам, которым он нужен, так что на пост проверяются только кандидаты.
+    Лейблы ленты, совпадающие с запросом или не проверяемые локально, получают
+    все её посты: их уже отфильтровала бура.
+    """
+
+    def __init__(self, query: str, labels: list, source_labels: list = None):
+        query_expr = parse_tag_expr(query)
+        own = {id(label) for label in labels}
+        self.by_tag, self.always = {}, []
+        for idx, label in enumerate(source_labels or labels):
+            expr = parse_tag_expr(label["tags"])
+            if id(label) in own and (query_expr is None or expr is None or expr == query_expr):
+                self.always.append((idx, label, frozenset(), frozenset()))
+                continue
+            # Чужой лейбл без локального выражения получает посты только из своей ленты
+            if expr is None: continue
+            pos, neg = expr
+            extra = sorted(pos - query_expr[0]) if query_expr else sorted(pos)
+            if extra:
+                self.by_tag.setdefault(extra[0], []).append((idx, label, pos, neg))
+            else:
+                self.always.append((idx, label, pos, neg))
+
+    def route(self, post: dict) -> list:
+        tags = set(str(post.get("tags") or "").lower().split())
+        candidates = self.always + [entry for tag in tags for entry in self.by_tag.get(tag, ())]
+        matched = {idx: label for idx, label, pos, neg in candidates if pos <= tags and not neg & tags}
+        return [matched[idx] for idx in sorted(matched)]
+
+class FeedProgress:
+    """Страницы одной ленты в порядке выборки.
+
+    Воркеры обрабатывают страницы в любом порядке, а курсор сдвигается только
+    через подряд идущие успешные: после неудачной страницы он стоит на месте,
+    и следующий опрос выберет её заново.
+    """
+
+    def __init__(self, src: str, tags: str):
+        self.src, self.tags = src, tags
+        self.cursors = []  # курсор после каждой выданной страницы
+        self.done = {}  # номер страницы -> обработана ли успешно
+        self.committed = 0  # сколько первых страниц уже учтено в курсоре
+        self.failed = False
+
+    def add(self, cursor) -> int:
+        self.cursors.append(cursor)
+        return len(self.cursors) - 1
+
+    async def finish(self, seq: int, ok: bool):
+        self.done[seq] = ok
+        cursor = None
+        while not self.failed and self.committed in self.done:
+            if not self.done.pop(self.committed):
+                self.failed = True
+                break
+            cursor = self.cursors[self.committed] or cursor
+            self.committed += 1
+        if cursor:
+            await advance_cursor(self.src, self.tags, cursor)
+
+feed_tasks = set()  # опросы лент, идущие прямо сейчас
+posts_in_flight = set()  # (источник, id), отданные на обработку одной из лент и ещё не обработанные
+fetch_sem = asyncio.Semaphore(PARSER_CONCURRENCY)
+
+async def process_feed_pages(pages: asyncio.Queue, progress: FeedProgress):
+    """Обрабатывает страницы ленты по очереди, пока она выбирает следующие."""
+    while (item := await pages.get()) is not None:
+        page, seq = item
+        ok = False
+        try:
+            ok = await process_parsed_page(page, progress.src)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки страницы {progress.src} ({progress.tags}): {e}")
+        finally:
+            posts_in_flight.difference_update((progress.src, str(post.get("id"))) for post, _ in page)
+            await progress.finish(seq, ok)
+
+async def poll_feed(src: str, tags: str, labels: list):
+    """Один опрос ленты: страницы выбираются под общим лимитом выборок и сразу уходят на обработку.
+
+    Следующий опрос ставится в расписание, только когда обработаны все
+    страницы: загруженная карточками лента тормозит себя, но не остальные.
+    """
+    key = (src, feed_key(tags))
+    router = LabelRouter(tags, labels, labels_by_source(LABELS).get(src, labels))
+    progress = FeedProgress(src, tags)
+    pages = asyncio.Queue(maxsize=PARSER_PAGE_BUFFER)
+    processor = asyncio.create_task(process_feed_pages(pages, progress))
+    fetched = 0
+    started = time.perf_counter()
+    try:
+        cursor = PARSER_CURSORS.get(key)
+        for _ in range(PARSER_MAX_PAGES):
+            if progress.failed: break
+            # С курсором просим только посты новее него, от старых к новым, чтобы листать вперёд
+            query = f"{tags} id:>{cursor} sort:id:asc" if cursor else tags
+            async with fetch_sem:
+                await parser_budget.acquire()
+                try:
+                    posts = await asyncio.wait_for(fetch_booru_posts(src, query, limit=PARSER_LIMIT), PARSER_FETCH_TIMEOUT)
+                except asyncio.TimeoutError:
+                    logger.warning(f"⚠️ {src} ({tags}) не ответил за {PARSER_FETCH_TIMEOUT} сек., пропускаем.")
+                    break
+            if not posts: break
+            fetched += len(posts)
+
+            # Посты, не подошедшие ни одному лейблу, не помечаем виденными:
+            # они могут понадобиться ленте с нелокальным выражением
+            page = []
+            for post in posts:
+                post_key = (src, str(post.get("id")))
+                if post_key in posts_in_flight: continue
+                matched = router.route(post)
+                if not matched: continue
+                posts_in_flight.add(post_key)
+                page.append((post, matched))
+            new_cursor = max((int(p["id"]) for p in posts if str(p.get("id", "")).isdigit()), default=cursor)
+            await pages.put((page, progress.add(new_cursor)))
+
+            # Без курсора (первый запуск) берём только свежую страницу, без истории
+            if not cursor or not new_cursor or new_cursor <= cursor or len(posts) < PARSER_LIMIT: break
+            cursor = new_cursor
+    except Exception as e:
+        logger.error(f"❌ Ошибка выборки {src} ({tags}): {e}")
+    finally:
+        await pages.put(None)
+        await processor
+        CYCLE_SECONDS.observe(time.perf_counter() - started)
+        await save_poll_state(key, poll_scheduler.record(key, fetched))
+
+async def run_parser_cycle(feeds: dict):
+    """Опрашивает ленты разом и ждёт, пока все обработаются (ручной прогон и бенчмарк)."""
+    await asyncio.gather(*(poll_feed(src, tags, labels) for (src, tags), labels in feeds.items()))
+
 async def parser_loop():
     logger.info("🚀 Фоновый парсер запущен!")
     while True:
         try:
+            delay = PARSER_SPEED
             if PARSER_ENABLED and LABELS:
-                for label in LABELS:
-                    sources = label.get("sources", ["rule34", "gelbooru"])
-                    tags = label.get("tags", "")
-                    if not tags: continue
-
-                    for src in sources:
-                        posts = await fetch_booru_posts(src, tags, limit=PARSER_LIMIT)
-                        for post in posts:
-                            await process_parsed_post(label, post, src)
-                            await asyncio.sleep(0.2)
-
-            await asyncio.sleep(max(1, PARSER_SPEED))
+                feeds = coordinator.owned_feeds(plan_feeds(LABELS))
+                poll_scheduler.sync(feeds.keys())
+                # Каждая наступившая лента опрашивается своей задачей, не дожидаясь остальных
+                for key in poll_scheduler.pop_due():
+                    task = asyncio.create_task(poll_feed(*key, feeds[key]))
+                    feed_tasks.add(task)
+                    task.add_done_callback(feed_tasks.discard)
+                delay = poll_scheduler.next_delay()
+
+            # Не дольше PARSER_SPEED, чтобы новые лейблы подхватывались без задержки
+            await asyncio.sleep(min(max(1, delay), max(1, PARSER_SPEED)))
         except (asyncio.CancelledError, Exception) as e:
             logger.error(f"❌ Ошибка в parser_loop: {e}")
             await asyncio.sleep(10)
 
+# --- НЕСКОЛЬКО ЭКЗЕМПЛЯРОВ ---
+
+def rendezvous_owner(feed: tuple, instances: list) -> str:
+    """Экземпляр с наибольшим хешем (экземпляр, лента): при уходе одного экземпляра переезжают только его ленты."""
+    def weight(instance: str) -> int:
+        digest = hashlib.blake2b(f"{instance}|{feed[0]}|{feed[1]}".encode(), digest_size=8).digest()
+        return int.from_bytes(digest, "big")
+    return max(instances, key=weight)
+
+class ShardCoordinator:
+    """Делит ленты парсера между экземплярами и разносит изменения лейблов.
+
+    Раз в INSTANCE_HEARTBEAT экземпляр шлёт пульс, по списку живых экземпляров
+    выбирает свои ленты rendezvous-хешированием и подтверждает их арендой в
+    feed_leases. Ленты упавшего экземпляра забирают после истечения аренды.
+    Лейблы приходят через LISTEN/NOTIFY на отдельном соединении.
+    """
+
+    def __init__(self):
+        self.owned = None  # None — без базы шардирования нет, парсер берёт все ленты
+        self.renewed_at = None  # monotonic-время отправки последнего успешного продления аренды
+        self.instances = [INSTANCE_ID]
+        self.listener = None
+        self.task = None
+        self.listen_failed = False
+        self.warned_polling = False
+
+    def owned_feeds(self, feeds: dict) -> dict:
+        if self.owned is None: return feeds
+        self.expire_leases()
+        return {key: labels for key, labels in feeds.items() if key in self.owned}
+
+    async def rebalance(self):
+        if not storage or not storage.shared: return
+        if self.owned is None:
+            # Пока аренда не подтверждена, ни одна лента не наша
+            self.owned = set()
+        await self.ensure_listener()
+        started = time.monotonic()
+        instances = await heartbeat_instance()
+        if instances is None:
+            self.expire_leases()
+            return
+        wanted = [key for key in plan_feeds(LABELS) if rendezvous_owner(key, instances) == INSTANCE_ID]
+        owned = await sync_feed_leases(wanted)
+        if owned is None:
+            self.expire_leases()
+            return
+
+        first = self.renewed_at is None
+        gained = owned - self.owned
+        if gained and not first:
+            # Прежний владелец мог уйти дальше по курсору — берём его состояние из базы
+            await load_cursors(list(gained))
+        if not first and (gained or self.owned - owned):
+            logger.info(f"🔀 Ленты перераспределены: +{len(gained)} / -{len(self.owned - owned)}, теперь у экземпляра {len(owned)} (живых экземпляров: {len(instances)})")
+        if len(instances) > 1 and not seen_filter.shared:
+            # Не сбрасываем до перезапуска: посты ушедших экземпляров в нашем фильтре так и не появятся
+            seen_filter.shared = True
+            logger.info("🔀 Рядом работают другие экземпляры: фильтр виденных постов больше не отвечает «точно нет».")
+        if len(instances) > 1 and not WEBHOOK_URL and not self.warned_polling:
+            self.warned_polling = True
+            logger.warning("⚠️ Несколько экземпляров в режиме polling: апдейты получит только один. Включите WEBHOOK_URL.")
+        self.owned, self.instances, self.renewed_at = owned, instances, started
+
+    def expire_leases(self):
+        """Отказывается от лент, если аренду не удавалось продлить дольше LEASE_TTL.
+
+        Аренда в базе к этому времени истекла и ленты могли достаться другим
+        экземплярам, поэтому опрашивать их дальше нельзя до следующего успешного продления.
+        """
+        if not self.owned: return
+        if self.renewed_at is not None and time.monotonic() - self.renewed_at < LEASE_TTL: return
+        logger.warning(f"⚠️ Аренда лент не продлевалась {LEASE_TTL} с — экземпляр перестаёт опрашивать {len(self.owned)} лент.")
+        self.owned = set()
+
+    async def ensure_listener(self):
+        if self.listener and not self.listener.is_closed(): return
+        # Пока подписки не было, уведомления терялись — после переподключения перечитываем состояние
+        stale = self.listener is not None or self.listen_failed
+        try:
+            listener = await storage.listen(CONFIG_CHANNEL, self.on_config_changed)
+        except Exception as e:
+            self.listen_failed = True
+            logger.error(f"❌ Ошибка подписки на изменения лейблов: {e}")
+            return
+        self.listener, self.listen_failed = listener, False
+        if stale: await load_state()
+
+    def on_config_changed(self, conn, pid: int, channel: str, payload: str):
+        if payload == INSTANCE_ID: return
+        asyncio.get_running_loop().create_task(self.reload_config(payload))
+
+    async def reload_config(self, origin: str):
+        logger.info(f"🔄 Лейблы изменены на экземпляре {origin}, перечитываем.")
+        await load_state()
+        await self.rebalance()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(INSTANCE_HEARTBEAT)
+            try:
+                await self.rebalance()
+            except Exception as e:
+                logger.error(f"❌ Ошибка перераспределения лент: {e}")
+                self.expire_leases()
+
+    async def start(self):
+        await self.rebalance()
+        if storage and storage.shared and not self.task:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task: self.task.cancel()
+        if self.listener and not self.listener.is_closed():
+            await self.listener.close()
+        await release_instance()
+
+    def describe(self) -> str:
+        if self.owned is None: return "Один экземпляр без базы, все ленты свои."
+        return f"Экземпляр <code>{INSTANCE_ID}</code>: лент {len(self.owned)}, живых экземпляров {len(self.instances)}."
+
+coordinator = ShardCoordinator()
+
 # --- ОБРАБОТЧИКИ КНОПОК В ГРУППЕ МОДЕРАЦИИ ---
 
 @dp.callback_query(F.data.startswith("mod:"))
@@ -294,22 +2382,26 @@ async def handle_mod_callback(callback: CallbackQuery):
     if action == "delete":
         try: await callback.message.delete()
         except: pass
+        await mod_store.discard(callback.message.chat.id, callback.message.message_id)
         await callback.answer("Скрыто!")
         return
 
     if action == "queue":
-        key = f"mod_{callback.message.message_id}"
-        meta = post_metadata_store.get(key, {})
-        file_url = meta.get("file_url") or (callback.message.photo[-1].file_id if callback.message.photo else None)
+        meta = await mod_store.get(callback.message.chat.id, callback.message.message_id) or {}
+        file_url = meta.get("file_url")
+        # Фото карточки уже лежит у Telegram — ставим в очередь его file_id, а не ссылку
+        file_id = callback.message.photo[-1].file_id if callback.message.photo else file_url
         caption = meta.get("caption", "")
+        post_key = media_post_key(meta["source"], meta["post_id"]) if meta.get("post_id") else None
 
-        if not file_url:
+        if not file_id:
             await callback.answer("❌ Ошибка получения файла.", show_alert=True)
             return
 
-        queue = await load_queue_db()
-        queue.append({"file_id": file_url, "type": "photo", "caption": caption})
-        await save_queue_db(queue)
+        if not await enqueue_post(file_id, caption, file_url=file_url, post_key=post_key):
+            await callback.answer("❌ Не удалось добавить в очередь.", show_alert=True)
+            return
+        await mod_store.discard(callback.message.chat.id, callback.message.message_id)
 
         await callback.message.edit_caption(
             caption=callback.message.caption + "\n\n✅ <b>ОДОБРЕНО И ДОБАВЛЕНО В ОЧЕРЕДЬ</b>"
@@ -318,69 +2410,149 @@ async def handle_mod_callback(callback: CallbackQuery):
 
 # --- ОБРАБОТЧИКИ В ЛИЧКЕ БОТА (ДАБЛЧЕК И ОЧЕРЕДЬ) ---
 
+QUEUE_PAGE_SIZE = 5
+
+# Превью очереди уходят одним альбомом, а кнопки всех постов страницы —
+# одним управляющим сообщением. callback_data: действие:id_в_очереди:id_превью
+def queue_item_row(item_id: int, preview_id: int, confirm: bool = False) -> list:
+    if confirm:
+        return [
+            InlineKeyboardButton(text=f"✅ Да, постим #{item_id}!", callback_data=f"confirmpost:{item_id}:{preview_id}"),
+            InlineKeyboardButton(text="❌ Отмена", callback_data=f"cancelpost:{item_id}:{preview_id}")
+        ]
+    return [
+        InlineKeyboardButton(text=f"🚀 Запостить #{item_id}", callback_data=f"askpost:{item_id}:{preview_id}"),
+        InlineKeyboardButton(text=f"🗑 Удалить #{item_id}", callback_data=f"delq:{item_id}:{preview_id}")
+    ]
+
+def parse_queue_callback(data: str):
+    """(id в publish_queue, id сообщения с превью) или None.
+
+    None — кнопка из /queue старой версии: там вместо id стоял индекс в списке,
+    и читать его как id значит удалить или опубликовать не тот пост.
+    """
+    parts = data.split(":")
+    if len(parts) != 3: return None
+    return int(parts[1]), int(parts[2])
+
+async def answer_stale_queue_button(callback: CallbackQuery):
+    await callback.answer("⚠️ Кнопка устарела. Откройте /queue заново.", show_alert=True)
+
+def replace_queue_row(markup: InlineKeyboardMarkup, item_id: int, new_row: list = None) -> InlineKeyboardMarkup:
+    rows = []
+    for row in markup.inline_keyboard:
+        data = row[0].callback_data or ""
+        parsed = None if data.startswith("queuepage:") else parse_queue_callback(data)
+        if parsed and parsed[0] == item_id:
+            if new_row: rows.append(new_row)
+        else:
+            rows.append(row)
+    return InlineKeyboardMarkup(inline_keyboard=rows)
+
+async def remember_preview_file_ids(items: list, msgs: list, sent: list):
+    """Элементы очереди, ушедшие ссылкой, получают file_id из ответа Telegram."""
+    for item, msg, photo in zip(items, msgs, sent):
+        if msg and msg.photo and photo.startswith("http") and item.get("post_key"):
+            await save_file_id(item["post_key"], msg.photo[-1].file_id)
+
+async def send_queue_previews(chat_id: int, items: list) -> list:
+    """Шлёт превью альбомом; если альбом не принят (битая ссылка), то по одному."""
+    captions = [f"📌 <b>Пост #{item['id']} в очереди</b>\n" + (item.get("caption") or "") for item in items]
+    try:
+        media = [InputMediaPhoto(media=item["file_id"], caption=cap) for item, cap in zip(items, captions)]
+        msgs = await outbox.submit(chat_id, bot.send_media_group, chat_id=chat_id, media=media, priority=PRIORITY_INTERACTIVE)
+        await remember_preview_file_ids(items, msgs, [item["file_id"] for item in items])
+        return [m.message_id for m in msgs]
+    except Exception as e:
+        logger.warning(f"⚠️ Альбом превью не отправлен ({e}), шлём по одному.")
+
+    preview_ids, msgs, sent = [], [], []
+    for item, cap in zip(items, captions):
+        msg, photo = None, ""
+        # Протухший file_id или битая ссылка: пробуем второй вариант, ссылку — с загрузкой из кэша
+        for photo in dict.fromkeys(filter(None, (item["file_id"], item.get("file_url")))):
+            try:
+                msg = await send_photo_with_fallback(chat_id, photo, caption=cap, priority=PRIORITY_INTERACTIVE)
+                break
+            except Exception:
+                continue
+        msgs.append(msg)
+        sent.append(photo)
+        if not msg:
+            msg = await outbox.submit(chat_id, bot.send_message, chat_id=chat_id, text=f"📌 <b>Пост #{item['id']}</b> (не удалось превью)\n{item.get('file_url') or item['file_id']}", priority=PRIORITY_INTERACTIVE)
+        preview_ids.append(msg.message_id)
+    await remember_preview_file_ids(items, msgs, sent)
+    return preview_ids
+
+async def send_queue_page(chat_id: int, after_id: int = 0):
+    items = await get_queue_page(after_id, QUEUE_PAGE_SIZE + 1)
+    has_more = len(items) > QUEUE_PAGE_SIZE
+    items = items[:QUEUE_PAGE_SIZE]
+    if not items: return
+
+    preview_ids = await send_queue_previews(chat_id, items)
+    rows = [queue_item_row(item["id"], preview_id) for item, preview_id in zip(items, preview_ids)]
+    if has_more:
+        rows.append([InlineKeyboardButton(text="➡️ Следующие посты", callback_data=f"queuepage:{items[-1]['id']}")])
+
+    await outbox.submit(
+        chat_id, bot.send_message,
+        chat_id=chat_id, text="🎛 <b>Управление постами выше:</b>",
+        reply_markup=InlineKeyboardMarkup(inline_keyboard=rows), priority=PRIORITY_INTERACTIVE
+    )
+
 @dp.message(F.text == "/queue")
 async def show_queue_cmd(message: Message):
     if not check_access(message.from_user.id): return
     if message.chat.type != "private":
-        await message.reply("Эту команду можно вызывать только в ЛС!")
+        await reply(message, "Эту команду можно вызывать только в ЛС!")
         return
 
-    queue = await load_queue_db()
-    if not queue:
-        await message.reply("📭 Очередь публикаций пуста.")
+    total = await get_queue_size()
+    if not total:
+        await reply(message, "📭 Очередь публикаций пуста.")
         return
 
-    await message.reply(f"📊 <b>Постов в очереди: {len(queue)} шт.</b>\nПрисылаю первые 5 постов с даблчек-кнопками:")
+    await reply(message, f"📊 <b>Постов в очереди: {total} шт.</b>\nПрисылаю первые {QUEUE_PAGE_SIZE} постов с даблчек-кнопками:")
+    await send_queue_page(message.chat.id)
 
-    for idx, item in enumerate(queue[:5]):
-        kb = InlineKeyboardMarkup(inline_keyboard=[
-            [
-                InlineKeyboardButton(text="🚀 Запостить сейчас", callback_data=f"askpost:{idx}"),
-                InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delq:{idx}")
-            ]
-        ])
-        
-        caption = f"📌 <b>Пост #{idx + 1} в очереди</b>\n" + (item.get("caption") or "")
-        file_id = item.get("file_id")
+@dp.callback_query(F.data.startswith("queuepage:"))
+async def next_queue_page(callback: CallbackQuery):
+    if not check_access(callback.from_user.id): return
+    after_id = int(callback.data.split(":")[1])
 
-        try:
-            await message.answer_photo(photo=file_id, caption=caption, reply_markup=kb)
-        except Exception:
-            await message.answer(f"📌 <b>Пост #{idx + 1}</b> (не удалось превью)\n{file_id}", reply_markup=kb)
+    rows = [row for row in callback.message.reply_markup.inline_keyboard if not (row[0].callback_data or "").startswith("queuepage:")]
+    await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=rows))
+    await callback.answer()
+    await send_queue_page(callback.message.chat.id, after_id)
 
 # Шаг 1 Даблчека: Запрос подтверждения
 @dp.callback_query(F.data.startswith("askpost:"))
 async def ask_confirm_post(callback: CallbackQuery):
     if not check_access(callback.from_user.id): return
-    idx = int(callback.data.split(":")[1])
-
-    confirm_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="✅ Да, постим прямо сейчас!", callback_data=f"confirmpost:{idx}"),
-            InlineKeyboardButton(text="❌ Отмена", callback_data=f"cancelpost:{idx}")
-        ]
-    ])
+    parsed = parse_queue_callback(callback.data)
+    if not parsed: return await answer_stale_queue_button(callback)
+    item_id, preview_id = parsed
 
-    await callback.message.edit_caption(
-        caption=callback.message.caption + "\n\n⚠️ <b>Вы уверены, что хотите опубликовать этот арт ВНЕ очереди прямо сейчас?</b>",
-        reply_markup=confirm_kb
+    await callback.message.edit_reply_markup(
+        reply_markup=replace_queue_row(callback.message.reply_markup, item_id, queue_item_row(item_id, preview_id, confirm=True))
     )
-    await callback.answer()
+    await callback.answer(f"Опубликовать пост #{item_id} ВНЕ очереди прямо сейчас?")
 
 # Шаг 2 Даблчека: Финальное подтверждение
 @dp.callback_query(F.data.startswith("confirmpost:"))
 async def confirm_post_now(callback: CallbackQuery):
     if not check_access(callback.from_user.id): return
-    idx = int(callback.data.split(":")[1])
+    parsed = parse_queue_callback(callback.data)
+    if not parsed: return await answer_stale_queue_button(callback)
+    item_id, _ = parsed
 
-    queue = await load_queue_db()
-    if 0 <= idx < len(queue):
-        item = queue.pop(idx)
-        await save_queue_db(queue)
-        
+    item = await dequeue_post(item_id)
+    if item:
         # Заглушка отправки (при слиянии подключится к CHANNEL_ID)
-        await callback.message.edit_caption(
-            caption=callback.message.caption + "\n\n🚀 <b>ПОСТ УСПЕШНО ОПУБЛИКОВАН В КАНАЛ!</b>"
+        await callback.message.edit_text(
+            text=callback.message.html_text + f"\n🚀 <b>Пост #{item_id} успешно опубликован в канал!</b>",
+            reply_markup=replace_queue_row(callback.message.reply_markup, item_id)
         )
         await callback.answer("Опубликовано!")
     else:
@@ -389,30 +2561,37 @@ async def confirm_post_now(callback: CallbackQuery):
 @dp.callback_query(F.data.startswith("cancelpost:"))
 async def cancel_post_now(callback: CallbackQuery):
     if not check_access(callback.from_user.id): return
-    idx = int(callback.data.split(":")[1])
-
-    original_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(text="🚀 Запостить сейчас", callback_data=f"askpost:{idx}"),
-            InlineKeyboardButton(text="🗑 Удалить", callback_data=f"delq:{idx}")
-        ]
-    ])
+    parsed = parse_queue_callback(callback.data)
+    if not parsed: return await answer_stale_queue_button(callback)
+    item_id, preview_id = parsed
 
-    clean_caption = callback.message.caption.split("\n\n⚠️")[0]
-    await callback.message.edit_caption(caption=clean_caption, reply_markup=original_kb)
+    await callback.message.edit_reply_markup(
+        reply_markup=replace_queue_row(callback.message.reply_markup, item_id, queue_item_row(item_id, preview_id))
+    )
     await callback.answer("Отменено.")
 
 @dp.callback_query(F.data.startswith("delq:"))
 async def delete_from_queue(callback: CallbackQuery):
     if not check_access(callback.from_user.id): return
-    idx = int(callback.data.split(":")[1])
-
-    queue = await load_queue_db()
-    if 0 <= idx < len(queue):
-        queue.pop(idx)
-        await save_queue_db(queue)
-        await callback.message.delete()
+    parsed = parse_queue_callback(callback.data)
+    if not parsed: return await answer_stale_queue_button(callback)
+    item_id, preview_id = parsed
+
+    if await dequeue_post(item_id):
+        await callback.message.edit_text(
+            text=callback.message.html_text + f"\n🗑 Пост #{item_id} удалён из очереди.",
+            reply_markup=replace_queue_row(callback.message.reply_markup, item_id)
+        )
+        if preview_id:
+            chat_id = callback.message.chat.id
+            try:
+                await outbox.submit(
+                    chat_id, bot.delete_message, chat_id=chat_id, message_id=preview_id, priority=PRIORITY_INTERACTIVE
+                )
+            except Exception: pass
         await callback.answer("Удалено из очереди!")
+    else:
+        await callback.answer("❌ Пост не найден в очереди.", show_alert=True)
 
 # --- ТЕКСТОВЫЕ КОМАНДЫ УПРАВЛЕНИЯ ---
 
@@ -425,12 +2604,12 @@ async def handle_commands(message: Message):
     if text == "/setmodgroup":
         MODERATION_CHAT_ID = message.chat.id
         await save_state()
-        await message.reply(f"✅ Эта группа привязана как **Группа Модерации**!\nID: <code>{MODERATION_CHAT_ID}</code>")
+        await reply(message, f"✅ Эта группа привязана как **Группа Модерации**!\nID: <code>{MODERATION_CHAT_ID}</code>")
 
     elif text.startswith("/addlabel"):
         parts = text.split(maxsplit=1)
         if len(parts) == 1:
-            await message.reply("⚙️ <b>Формат:</b>\n<code>/addlabel Имя | теги | источники | эмодзи | режим | подпись</code>")
+            await reply(message, "⚙️ <b>Формат:</b>\n<code>/addlabel Имя | теги | источники | эмодзи | режим | подпись</code>")
             return
         try:
             raw = parts[1].split("|")
@@ -441,53 +2620,165 @@ async def handle_commands(message: Message):
             LABELS[:] = [lbl for lbl in LABELS if lbl["name"].lower() != lname.lower()]
             LABELS.append({"name": lname, "tags": ltags, "sources": sources, "emoji": lemoji, "mode": lmode.upper(), "signature": lsig})
             await save_state()
-            await message.reply(f"✅ Лейбл <b>{lname}</b> успешно сохранен!")
+            await reply(message, f"✅ Лейбл <b>{lname}</b> успешно сохранен!")
         except Exception as e:
-            await message.reply(f"❌ Ошибка формата: {e}")
+            await reply(message, f"❌ Ошибка формата: {e}")
+
+    elif text == "/stats":
+        await reply(message, f"📈 <b>Фильтр виденных постов</b>\n{seen_filter.describe()}\n\n⏱ <b>Расписание опроса</b>\n{poll_scheduler.describe()}\n\n🔀 <b>Экземпляры</b>\n{coordinator.describe()}")
 
     elif text == "/labels":
         if not LABELS:
-            await message.reply("📭 Лейблов нет.")
+            await reply(message, "📭 Лейблов нет.")
             return
         txt = "🏷 <b>Активные лейблы:</b>\n\n"
         for i, l in enumerate(LABELS, 1):
             txt += f"{i}. {l.get('emoji', '🏷')} <b>{l['name']}</b> ({l.get('mode')})\n• Теги: <code>{l['tags']}</code>\n\n"
-        await message.reply(txt)
+        await reply(message, txt)
 
     elif text.startswith("/checkpost"):
         parts = text.split(maxsplit=1)
         search_tag = parts[1].strip() if len(parts) > 1 else "femboy"
         target = MODERATION_CHAT_ID if MODERATION_CHAT_ID else message.chat.id
 
-        await message.reply(f"🔍 Запрос к Rule34/Gelbooru по тегу <code>{search_tag}</code>...")
+        await reply(message, f"🔍 Запрос к Rule34/Gelbooru по тегу <code>{search_tag}</code>...")
         posts = await fetch_booru_posts("rule34", search_tag, limit=5)
         if not posts: posts = await fetch_booru_posts("gelbooru", search_tag, limit=5)
 
         if not posts:
-            await message.reply("❌ Постов не найдено.")
+            await reply(message, "❌ Постов не найдено.")
             return
 
         p = posts[0]
         caption = f"🧪 <b>Проверочный пост</b>\n🆔 ID: <code>{p.get('id')}</code>\n🔗 {p.get('file_url')}"
-        await bot.send_photo(chat_id=target, photo=p.get('file_url'), caption=caption)
+        await send_photo_with_fallback(target, p.get('file_url'), md5=p.get('md5'), caption=caption, priority=PRIORITY_INTERACTIVE)
+
+# --- HTTP-СЕРВЕР: HEALTH, МЕТРИКИ, ПРОФИЛИРОВЩИК ---
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик: раз в interval снимает стек потока event loop.
+
+    Копит свёрнутые стеки (формат flamegraph.pl / speedscope) и почти не
+    нагружает процесс, поэтому его можно включать прямо на проде.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = {}
+        self.stop_event = threading.Event()
+        self.target = threading.main_thread().ident
+        self.names = {}  # код функции -> "имя (файл"
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            # Только имя и строка из самих фреймов: без linecache, который читает исходники под GIL
+            frames = []
+            while frame is not None:
+                code = frame.f_code
+                name = self.names.get(code)
+                if name is None:
+                    name = self.names[code] = f"{code.co_name} ({os.path.basename(code.co_filename)}"
+                frames.append(f"{name}:{frame.f_lineno})")
+                frame = frame.f_back
+            if not frames: continue
+            stack = ";".join(reversed(frames))
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    async def profile(self, seconds: float) -> str:
+        thread = threading.Thread(target=self.run, name="profiler", daemon=True)
+        thread.start()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            self.stop_event.set()
+            thread.join()
+        return "\n".join(f"{stack} {count}" for stack, count in sorted(self.samples.items(), key=lambda kv: -kv[1]))
+
+async def health_handler(request: web.Request):
+    return web.Response(text="ok")
+
+async def metrics_handler(request: web.Request):
+    QUEUE_DEPTH.set(await get_queue_size())
+    return web.Response(body=generate_latest(), headers={"Content-Type": CONTENT_TYPE_LATEST})
+
+async def profile_handler(request: web.Request):
+    if not PROFILER_ENABLED:
+        raise web.HTTPNotFound()
+    try:
+        seconds = float(request.query.get("seconds", "10"))
+    except ValueError:
+        seconds = math.nan
+    if not seconds > 0:
+        raise web.HTTPBadRequest(text="seconds должно быть положительным числом")
+    seconds = min(seconds, 120)
+    return web.Response(text=await SamplingProfiler().profile(seconds))
+
+async def start_web_server() -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/", health_handler)
+    app.router.add_get("/healthz", health_handler)
+    app.router.add_get("/metrics", metrics_handler)
+    app.router.add_get("/debug/profile", profile_handler)
+    if WEBHOOK_URL:
+        # Отвечаем Telegram сразу, апдейт обрабатывается отдельной задачей в этом же loop
+        SimpleRequestHandler(dispatcher=dp, bot=bot, handle_in_background=True, secret_token=WEBHOOK_SECRET).register(app, path=WEBHOOK_PATH)
+
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "0.0.0.0", WEB_PORT).start()
+    logger.info(f"🌐 HTTP-сервер слушает порт {WEB_PORT} (/healthz, /metrics{', ' + WEBHOOK_PATH if WEBHOOK_URL else ''})")
+    return runner
 
 # --- СТАРТ ---
 
 async def main():
-    await init_db()
+    db_ready = await init_db()
     await load_state()
+    await load_cursors()
+    await warm_seen_filter()
 
     await bot.set_my_commands([
         BotCommand(command="queue", description="📊 Очередь и мгновенный постинг (Даблчек)"),
         BotCommand(command="labels", description="🏷 Посмотреть активные лейблы"),
         BotCommand(command="addlabel", description="➕ Добавить лейбл сбора"),
         BotCommand(command="checkpost", description="🔍 Прислать 1-й арт по тегу"),
+        BotCommand(command="stats", description="📈 Статистика парсера"),
         BotCommand(command="setmodgroup", description="📌 Привязать эту группу для модерации"),
     ])
 
-    asyncio.create_task(parser_loop())
-    logger.info("🤖 Бот-агрегатор успешно запущен!")
-    await dp.start_polling(bot)
+    await init_http()
+    await asyncio.to_thread(media_cache.load)
+    outbox.start()
+    web_runner = await start_web_server()
+    try:
+        await coordinator.start()
+        if db_ready:
+            asyncio.create_task(parser_loop())
+            asyncio.create_task(seen_maintenance_loop())
+        else:
+            # Без рабочей дедупликации парсер слал бы одни и те же посты каждый проход
+            logger.error("❌ База не готова — парсер не запущен. Исправьте ошибку выше и перезапустите бота.")
+        if WEBHOOK_URL:
+            # Вебхук не снимаем при остановке: апдейты дождутся следующего запуска на стороне Telegram
+            await bot.set_webhook(
+                f"{WEBHOOK_URL}{WEBHOOK_PATH}", secret_token=WEBHOOK_SECRET,
+                allowed_updates=dp.resolve_used_update_types()
+            )
+            logger.info(f"🤖 Бот-агрегатор успешно запущен! Вебхук: {WEBHOOK_URL}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        else:
+            # getUpdates не работает, пока стоит вебхук от прошлого запуска
+            await bot.delete_webhook()
+            logger.info("🤖 Бот-агрегатор успешно запущен!")
+            await dp.start_polling(bot)
+    finally:
+        await coordinator.stop()
+        await web_runner.cleanup()
+        await close_http()
+        await bot.session.close()
+        hash_pool.shutdown(wait=False)
+        if storage: await storage.close()
 
 if __name__ == "__main__":
     try: